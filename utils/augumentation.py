@@ -1,10 +1,15 @@
 import cv2
 import os
 from pathlib import Path
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from scipy.ndimage import rotate,shift
 import random
 import argparse
 import os
+import time
+import numpy as np
 
 # working Directory
 workingDirectory = Path.cwd()
@@ -22,6 +27,152 @@ folderAugMsk = Path('Ressources/msk_augmented_path')
 default_images_aug_path = workingDirectory / folderAugImg
 default_masks_aug_path = workingDirectory / folderAugMsk
 default_seed = 42
+default_memory_limit = 2 << 30  # bytes of images a lazy Augumentator materializes at once
+
+def pair_files(img_path, msk_path, extensions=('.jpg', '.jpeg', '.png')):
+    """
+    Pairs the images of a folder with their masks by file stem, e.g. image0000785.jpg with image0000785_masked.png.
+
+    Files without a counterpart are reported and left out, so they cannot shift the pairs after them.
+
+    Returns:
+        list: (stem, image file name, mask file name) tuples sorted by stem.
+    """
+    images, masks = {}, {}
+    if Path(img_path).exists():
+        for im in os.listdir(img_path):
+            if im.endswith(extensions):
+                images[im.rsplit('.', 1)[0]] = im
+    if Path(msk_path).exists():
+        for msk in os.listdir(msk_path):
+            if msk.endswith(extensions):
+                stem = msk.rsplit('.', 1)[0]
+                masks[stem[:-len('_masked')] if stem.endswith('_masked') else stem] = msk
+    
+    for stem in sorted(images.keys() - masks.keys()):
+        print(f"No mask found for {images[stem]}, skipped")
+    for stem in sorted(masks.keys() - images.keys()):
+        print(f"No image found for {masks[stem]}, skipped")
+    return [(stem, images[stem], masks[stem]) for stem in sorted(images.keys() & masks.keys())]
+
+
+class LazyImages(Sequence):
+    """A list-like view of the images of a folder, which reads and transforms an image only when it is accessed."""
+
+    def __init__(self, folder, names, ops=()):
+        """
+        Args:
+            folder (Path): The directory containing the images.
+            names (list): The file names of the images, in order.
+            ops (tuple): Functions applied one after another to every image after reading it.
+        """
+        self.folder = Path(folder)
+        self.names = names
+        self.ops = tuple(ops)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, id):
+        if isinstance(id, slice):
+            return [self[i] for i in range(*id.indices(len(self)))]
+        image = cv2.imread(str(self.folder / self.names[id]))
+        if image is None:
+            # unreadable, the queued transformations cannot run on it
+            return None
+        for op in self.ops:
+            image = op(image)
+        return image
+
+    def map(self, op):
+        """Returns a new view with `op` appended to the transformations, nothing is read yet."""
+        return LazyImages(self.folder, self.names, self.ops + (op,))
+
+
+class AffinePipeline:
+    """
+    Chains rotations, flips and translations into a single affine matrix, so that an image is resampled once
+    with `cv2.warpAffine` instead of once per operation.
+
+    The operations follow the conventions of the `Augumentator` methods: positive angles rotate counter
+    clockwise around the image centre, positive pixels move the content right/down.
+    """
+
+    def __init__(self, border_mode=cv2.BORDER_REPLICATE):
+        """
+        Args:
+            border_mode (int): OpenCV border mode for the pixels moved in from outside the image. The default
+                repeats the edge pixels like the rotation does, cv2.BORDER_CONSTANT fills zeros like the translations.
+        """
+        self.steps = []
+        self.border_mode = border_mode
+
+    @classmethod
+    def random(cls, rng, angle_range=(-30, 30), pixel_range=(-20, 20), flip_probability=0.5, border_mode=cv2.BORDER_REPLICATE):
+        """
+        Draws a random rotation, flips and translation from a numpy Generator, e.g. a fresh one per sample and epoch.
+
+        Args:
+            rng (np.random.Generator): The source of randomness.
+            angle_range (tuple): Range of the rotation angle.
+            pixel_range (tuple): Range of the horizontal and vertical translation.
+            flip_probability (float): Probability of each of the two flips.
+        """
+        pipeline = cls(border_mode).rotation(rng.uniform(*angle_range))
+        if rng.random() < flip_probability:
+            pipeline.h_flip()
+        if rng.random() < flip_probability:
+            pipeline.v_flip()
+        return pipeline.h_transl(rng.uniform(*pixel_range)).v_transl(rng.uniform(*pixel_range))
+
+    def rotation(self, angle):
+        self.steps.append(('rotation', angle))
+        return self
+
+    def h_flip(self):
+        self.steps.append(('h_flip', None))
+        return self
+
+    def v_flip(self):
+        self.steps.append(('v_flip', None))
+        return self
+
+    def h_transl(self, pixels):
+        self.steps.append(('h_transl', pixels))
+        return self
+
+    def v_transl(self, pixels):
+        self.steps.append(('v_transl', pixels))
+        return self
+
+    def matrix(self, height, width):
+        """Returns the 2x3 matrix of all steps for an image of the given size."""
+        matrix = np.eye(3)
+        for op, value in self.steps:
+            step = np.eye(3)
+            if op == 'rotation':
+                step[:2] = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), value, 1.0)
+            elif op == 'h_flip':
+                step[0] = [-1, 0, width - 1]
+            elif op == 'v_flip':
+                step[1] = [0, -1, height - 1]
+            elif op == 'h_transl':
+                step[0, 2] = value
+            elif op == 'v_transl':
+                step[1, 2] = value
+            matrix = step @ matrix
+        return matrix[:2]
+
+    def apply(self, img, interpolation=cv2.INTER_LINEAR):
+        """Resamples an image once with the combined matrix."""
+        height, width = img.shape[:2]
+        return cv2.warpAffine(img, self.matrix(height, width), (width, height),
+                              flags=interpolation, borderMode=self.border_mode)
+
+    def apply_mask(self, msk):
+        """Resamples a mask with nearest neighbour interpolation, so no new label values appear."""
+        return self.apply(msk, interpolation=cv2.INTER_NEAREST)
+
 
 class Augumentator:
     """A class for augmenting images with various transformations such as rotations, flips, and translations."""
@@ -29,7 +180,9 @@ class Augumentator:
     def __init__(self,
                  img_path=default_images_path,
                  msk_path=default_masks_path,
-                 seed = default_seed):
+                 seed = default_seed,
+                 lazy = False,
+                 memory_limit = default_memory_limit):
         """
         Initializes the Augmentator with paths for images and masks, and a seed for randomness.
 
@@ -37,6 +190,9 @@ class Augumentator:
             img_path (Path): The file path to the directory containing images.
             msk_path (Path): The file path to the directory containing masks.
             seed (int): Seed value for random number generator to ensure reproducibility.
+            lazy (bool): Do not load the images up front. `self.images`/`self.masks` are then `LazyImages`
+                views, the transformations are recorded on them and only run when a sample is accessed or saved.
+            memory_limit (int): Bytes of transformed images a lazy Augumentator keeps in memory while saving.
         """
         self.img_path = Path(img_path)
         self.msk_path = Path(msk_path)
@@ -49,23 +205,34 @@ class Augumentator:
         self.seed = seed
         random.seed(self.seed)
         self.inplace=None
+        self.lazy = lazy
+        self.memory_limit = memory_limit
+        
+        # index the pictures and its masks by stem, so that image i always belongs to mask i
+        self.pairs = pair_files(self.img_path, self.msk_path)
+        self.images_name = [im for _, im, _ in self.pairs]
+        self.masks_name = [msk for _, _, msk in self.pairs]
+        
+        if self.lazy:
+            # the pictures and its masks are read when needed
+            self.images = LazyImages(self.img_path, self.images_name)
+            self.masks = LazyImages(self.msk_path, self.masks_name)
+            return
         
         # load pictures and its masks
-        if self.img_path.exists():
-            for im in os.listdir(self.img_path):
-                if im.endswith(('.jpg', '.jpeg', '.png')):
-                    image = cv2.imread(str(self.img_path / im))
-                    if image is not None:
-                        self.images.append(image)
-                        self.images_name.append(im)
-                
-        if self.msk_path.exists():
-            for msk in os.listdir(self.msk_path):
-                if msk.endswith(('.jpg', '.jpeg', '.png')):
-                    mask = cv2.imread(str(self.msk_path / msk))
-                    if mask is not None:
-                        self.masks.append(mask)
-                        self.masks_name.append(msk)
+        pairs = []
+        for stem, im, msk in self.pairs:
+            image = cv2.imread(str(self.img_path / im))
+            mask = cv2.imread(str(self.msk_path / msk))
+            if image is None or mask is None:
+                print(f"Could not read {im if image is None else msk}, skipped the pair {stem}")
+                continue
+            pairs.append((stem, im, msk))
+            self.images.append(image)
+            self.masks.append(mask)
+        self.pairs = pairs
+        self.images_name = [im for _, im, _ in self.pairs]
+        self.masks_name = [msk for _, _, msk in self.pairs]
 
     def global_inplace(self,on_off):
         self.inplace = bool(on_off)
@@ -75,77 +242,91 @@ class Augumentator:
         self.seed = seed
         random.seed(self.seed)
 
-    def rotation(self,angle_range=(-30, 30),inplace=False):
-        """Rotate images randomly within a specified angle range."""
+    def transform(self,img_op,msk_op=None,inplace=False):
+        """
+        Apply a function to every image/mask pair, lazily when the Augumentator is lazy.
+        
+        The mask goes through `msk_op` if given (e.g. the nearest neighbour variant of the same warp),
+        otherwise through the same `img_op` as its image.
+        """
         if self.inplace: inplace =self.inplace
+        msk_op = msk_op or img_op
         
-        r_img = []
-        r_msk = []
-        angle = random.randint(*angle_range)
-        for img in self.images:
-            rotated_img = rotate(img, angle=angle, reshape=False, mode='nearest')
-            r_img.append(rotated_img)
-        for msk in self.masks:
-            rotated_msk = rotate(msk, angle=angle, reshape=False, mode='nearest')
-            r_msk.append(rotated_msk)  
+        if self.lazy:
+            t_img, t_msk = self.images.map(img_op), self.masks.map(msk_op)
+        else:
+            t_img, t_msk = [], []
+            for img, msk in zip(self.images, self.masks):
+                t_img.append(img_op(img))
+                t_msk.append(msk_op(msk))
+            if isinstance(self.images, np.ndarray):
+                t_img, t_msk = np.stack(t_img), np.stack(t_msk)
         if inplace:
-            self.images,self.masks = r_img,r_msk          
-        return r_img,r_msk
+            self.images,self.masks = t_img,t_msk
+        return t_img,t_msk
+
+    def rotation(self,angle_range=(-30, 30),inplace=False):
+        """Rotate images randomly within a specified angle range."""
+        angle = random.randint(*angle_range)
+        op = partial(rotate, angle=angle, reshape=False, mode='nearest')
+        return self.transform(op, inplace=inplace)
     
 
     def h_flip(self,inplace=False):
         """Flip images horizontally."""
-        if self.inplace: inplace =self.inplace
-        
-        hflipped_img = [cv2.flip(img, 1) for img in self.images]
-        hflipped_msk = [cv2.flip(msk, 1) for msk in self.masks]
-        if inplace:
-            self.images,self.masks = hflipped_img,hflipped_msk
-        return hflipped_img,hflipped_msk
+        op = partial(cv2.flip, flipCode=1)
+        return self.transform(op, inplace=inplace)
 
     def v_flip(self,inplace=False):
         """Flip images vertically."""
-        if self.inplace: inplace =self.inplace
-        
-        vflipped_img = [cv2.flip(img, 0) for img in self.images]
-        vflipped_msk = [cv2.flip(msk, 0) for msk in self.masks]
-        if inplace:
-            self.images,self.masks = vflipped_img,vflipped_msk
-        return vflipped_img,vflipped_msk
+        op = partial(cv2.flip, flipCode=0)
+        return self.transform(op, inplace=inplace)
 
     def h_transl(self, pixel_range=(-20, 20),inplace=False):
         """Translate images horizontally within a specified pixel range. default values are -20 to 20"""
-        if self.inplace: inplace =self.inplace
-        
-        htranslated_img = []
-        htranslated_msk = []
         pixels = random.randint(*pixel_range)
-        for img in self.images:
-            translated_img = shift(img, [0, pixels, 0])
-            htranslated_img.append(translated_img)
-        for msk in self.masks:
-            translated_msk = shift(msk, [0, pixels, 0])
-            htranslated_msk.append(translated_msk)
-        if inplace:
-            self.images,self.masks = htranslated_img,htranslated_msk
-        return htranslated_img,htranslated_msk
+        op = partial(shift, shift=[0, pixels, 0])
+        return self.transform(op, inplace=inplace)
 
     def v_transl(self, pixel_range=(-20, 20),inplace=False):
         """Translate images vertically within a specified pixel range. default values are -20 to 20"""
-        if self.inplace: inplace =self.inplace
-        
-        vtranslated_img = []
-        vtranslated_msk = []
         pixels = random.randint(*pixel_range)
-        for img in self.images:
-            translated_img = shift(img, [pixels, 0, 0])
-            vtranslated_img.append(translated_img)
-        for msk in self.masks:
-            translated_msk = shift(msk, [0, pixels, 0])
-            vtranslated_msk.append(translated_msk)
-        if inplace:
-            self.images,self.masks = vtranslated_img,vtranslated_msk
-        return vtranslated_img,vtranslated_msk
+        op = partial(shift, shift=[pixels, 0, 0])
+        return self.transform(op, inplace=inplace)
+
+    def fused(self, processes, angle_range=(-30, 30), pixel_range=(-20, 20), border_mode=cv2.BORDER_REPLICATE, inplace=False):
+        """
+        Apply a chain of operations as one affine warp per image, masks with nearest neighbour interpolation.
+        
+        The random angles and shifts are drawn in the same order as calling the single methods one after
+        another, so the same seed gives the same parameters. Unlike the chain, every image is resampled once.
+        
+        Args:
+            processes (list): Names of the operations in order, e.g. ['rotation', 'h_flip', 'v_flip', 'v_transl'].
+            angle_range (tuple): Range of the rotation angles.
+            pixel_range (tuple): Range of the translations.
+            border_mode (int): See `AffinePipeline`.
+        """
+        pipeline = AffinePipeline(border_mode)
+        for process in processes:
+            if process == 'rotation':
+                pipeline.rotation(random.randint(*angle_range))
+            elif process in ('h_transl', 'v_transl'):
+                getattr(pipeline, process)(random.randint(*pixel_range))
+            else:
+                getattr(pipeline, process)()
+        return self.transform(pipeline.apply, pipeline.apply_mask, inplace)
+
+    def stack(self):
+        """
+        Turn the loaded images and masks into aligned (N, H, W, 3) arrays, sample i of both belongs together.
+        
+        Requires all images to have the same size. The transformations keep working on the arrays.
+        """
+        if self.lazy:
+            raise ValueError("a lazy Augumentator does not hold its images, read them through self.images")
+        self.images, self.masks = np.stack(self.images), np.stack(self.masks)
+        return self.images, self.masks
       
     def save(self,
               img_path=default_images_aug_path,
@@ -182,12 +363,73 @@ class Augumentator:
         if not os.path.exists(Path(mask_path)):  
             os.makedirs(mask_path)
         
-        for id, img in enumerate(self.images):
-            img_filename = "aug_" +str(self.counter) +"_"+ self.images_name[id].rsplit('.', 1)[0] + img_extension
-            cv2.imwrite(str(Path(img_path) / img_filename), img)
-        for id, msk in enumerate(self.masks):
-            msk_filename = "aug_" +str(self.counter) +"_"+self.masks_name[id].rsplit('.', 1)[0] + img_extension
-            cv2.imwrite(str(Path(mask_path) / msk_filename), msk)
+        self.write(self.images, self.images_name, img_path, img_extension)
+        self.write(self.masks, self.masks_name, mask_path, img_extension)
+
+    def write(self, images, names, path, img_extension):
+        """
+        Write images as aug_<counter>_<name>.
+        
+        Lazy images are read, transformed and written by a pool of threads. The pool is sized so that the
+        images being worked on at the same time stay below `self.memory_limit`.
+        """
+        out_paths = [str(Path(path) / ("aug_" +str(self.counter) +"_"+ name.rsplit('.', 1)[0] + img_extension)) for name in names]
+        if not self.lazy:
+            for out_path, img in zip(out_paths, images):
+                cv2.imwrite(out_path, img)
+            return
+        if len(images) == 0:
+            return
+        
+        def write_one(id):
+            img = images[id]
+            if img is None:
+                print(f"Could not read {names[id]}, skipped")
+                return 0
+            cv2.imwrite(out_paths[id], img)
+            return img.nbytes
+        
+        # the first readable image tells how many fit into the memory limit at once
+        image_bytes, start = 0, 0
+        while not image_bytes and start < len(images):
+            image_bytes = write_one(start)
+            start += 1
+        workers = max(1, min(os.cpu_count() or 1, self.memory_limit // max(image_bytes, 1)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(write_one, range(start, len(images))):
+                pass
+
+
+def benchmark_fused(img_path=default_images_path, msk_path=default_masks_path,
+                    processes=('rotation', 'h_flip', 'v_flip', 'v_transl'), seed=default_seed):
+    """
+    Times the chained single operations against the fused warp on the images of a folder.
+
+    Returns:
+        dict: Seconds per image pair for both paths.
+    """
+    augmenter = Augumentator(img_path, msk_path, seed)
+    images, masks = augmenter.images, augmenter.masks
+    count = max(len(images), 1)
+    
+    augmenter.set_seed(seed)
+    start = time.perf_counter()
+    for process in processes:
+        getattr(augmenter, process)(inplace=True)
+    chained = (time.perf_counter() - start) / count
+    chained_images = augmenter.images
+    
+    augmenter.images, augmenter.masks = images, masks
+    augmenter.set_seed(seed)
+    start = time.perf_counter()
+    augmenter.fused(processes, inplace=True)
+    fused = (time.perf_counter() - start) / count
+    
+    difference = np.mean([np.mean(np.abs(a.astype(np.float32) - b)) for a, b in zip(chained_images, augmenter.images)])
+    print(f"chained {' -> '.join(processes)}: {1000 * chained:.1f} ms per image pair")
+    print(f"fused: {1000 * fused:.1f} ms per image pair, speedup x{chained / fused:.1f}")
+    print(f"mean absolute difference of the images: {difference:.2f} grey values")
+    return {'chained': chained, 'fused': fused}
 
 
 def parse_args():
@@ -202,6 +444,7 @@ def parse_args():
     parser.add_argument("--seed", type=int, default=42, help="Seed for random number generator.")
     parser.add_argument("--processes", type=str, choices=['rotation', 'h_flip', 'v_flip', 'h_transl', 'v_transl'],default=None,
                         help="list of numbers to apply augmentation which separated by + (choices: 1:rotation, 2:h_flip, 3:v_flip, 4:h_transl, 5:v_transl.")   
+    parser.add_argument("--fused", action="store_true", help="Apply the operations as a single affine warp per image.")
     args = parser.parse_args()
     if args.interactive:
         args = parse_interactive_args()
@@ -217,6 +460,7 @@ def parse_interactive_args():
     seed = int(input("Enter seed for random number generator (default: 42): ") or 42)
     processes = input("Enter list of numbers to apply augmentation and separated numbers with + (choices: 1:rotation, 2:h_flip, 3:v_flip, 4:h_transl, 5:v_transl): ") or None
     save_in_tiff = input("save in which format,default in the same format as orignal (default: False): ") or False
+    fused = bool(int(input("apply the operations as a single warp per image? 1 for yes and 0 for no (default: 0): ") or 0))
     class Args:
         def __init__(self):
             self.img_path = img_path
@@ -226,6 +470,7 @@ def parse_interactive_args():
             self.seed = seed
             self.processes = processes
             self.save_in_tiff = save_in_tiff
+            self.fused = fused
             self.interactive = True
     
     return Args()
@@ -233,6 +478,9 @@ def parse_interactive_args():
 
 def main():
     def process(args,inplace=False):
+        if args.fused:
+            augmenter.fused([num2op[num] for num in args.processes.split('+') if num], inplace=inplace)
+            return
         for process in args.processes.split('+'):
             if process is not None and process != "":
                 # Process selected augmentations
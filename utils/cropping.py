@@ -1,7 +1,17 @@
 import cv2
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import argparse
+try:
+    from utils.manifest import Manifest
+except ImportError:  # run as a script from inside utils/
+    from manifest import Manifest
 
 
 ###working Directory
@@ -17,6 +27,183 @@ default_in_folder = workingDirectory / folderImg
 default_out_folder = workingDirectory / folderCroppedImg
 default_crop_width = 1400
 default_crop_height = 1840
+default_workers = os.cpu_count() or 1
+
+
+def crop_box(width, height, crop_width, crop_height):
+    """Returns the (start_x, end_x, start_y, end_y) of the centre crop window of an image."""
+    start_x = max(width // 2 - crop_width // 2, 0)
+    end_x = min(start_x + crop_width, width)
+    start_y = max(height // 2 - crop_height // 2, 0)
+    end_y = min(start_y + crop_height, height)
+    return start_x, end_x, start_y, end_y
+
+
+# cv2 flags that let libjpeg decode directly at 1/2, 1/4 or 1/8 of the resolution
+reduced_read_flags = {1: cv2.IMREAD_COLOR,
+                      2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def jpeg_header(img_path):
+    """
+    Reads the frame header of a baseline/progressive JPEG without decoding it.
+
+    Returns:
+        tuple: (width, height, imcu_width, imcu_height), or None if the file is no such JPEG.
+    """
+    with open(img_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            length = int.from_bytes(f.read(2), 'big')
+            if marker[1] in (0xC0, 0xC1, 0xC2):
+                segment = f.read(length - 2)
+                height = int.from_bytes(segment[1:3], 'big')
+                width = int.from_bytes(segment[3:5], 'big')
+                components = segment[6:6 + 3 * segment[5]]
+                max_h = max(components[k + 1] >> 4 for k in range(0, len(components), 3))
+                max_v = max(components[k + 1] & 15 for k in range(0, len(components), 3))
+                return width, height, 8 * max_h, 8 * max_v
+            f.seek(length - 2, 1)
+
+
+def lossless_crop(img_path, out_path, crop_width, crop_height):
+    """
+    Crops a JPEG with jpegtran, which cuts the DCT blocks without decoding and re-encoding them.
+
+    The window keeps its size but its top left corner is moved up/left onto the iMCU grid
+    (at most 15 pixels for 4:2:0 images), since JPEG can only be cut at block boundaries.
+
+    Returns:
+        bool: True if the crop was written, False if the file or platform does not allow it.
+    """
+    jpegtran = shutil.which('jpegtran')
+    header = jpeg_header(img_path)
+    if jpegtran is None or header is None:
+        return False
+    width, height, imcu_width, imcu_height = header
+    start_x, end_x, start_y, end_y = crop_box(width, height, crop_width, crop_height)
+    crop_spec = f"{end_x - start_x}x{end_y - start_y}+{start_x - start_x % imcu_width}+{start_y - start_y % imcu_height}"
+    result = subprocess.run([jpegtran, '-crop', crop_spec, '-copy', 'all', '-outfile', out_path, img_path],
+                            capture_output=True)
+    return result.returncode == 0
+
+
+def read_crop(img_path, crop_width, crop_height, reduce=1):
+    """
+    Decodes an image and returns its centre crop.
+
+    Args:
+        img_path (str): Path to the image.
+        crop_width (int): The width of the crop area in full resolution pixels.
+        crop_height (int): The height of the crop area in full resolution pixels.
+        reduce (int): 1, 2, 4 or 8. JPEGs are decoded at 1/reduce of their resolution inside
+            libjpeg (other formats are resized after decoding), the crop is scaled accordingly.
+            Only use it when the crops are resized further downstream anyway, and not for label masks.
+    """
+    img = cv2.imread(img_path, reduced_read_flags[reduce])
+    if img is None:
+        return None
+    height, width = img.shape[:2]
+    start_x, end_x, start_y, end_y = crop_box(width, height, crop_width // reduce, crop_height // reduce)
+    return img[start_y:end_y, start_x:end_x]
+
+
+def output_filename(filename, save_in_tiff=False):
+    """Returns the file name a cropped image is saved under."""
+    if not save_in_tiff:
+        return filename
+    last_dot_index = filename.rfind(".")
+    return filename[:last_dot_index]+".tiff"
+
+
+def crop_file(filename, in_folder, out_folder, crop_width, crop_height, save_in_tiff=False, reduce=1, lossless=False):
+    """
+    Crops a single image and saves it to the output directory.
+
+    Kept at module level so it can be shipped to the workers of a process pool.
+
+    Returns:
+        str: None on success, otherwise a description of the error.
+    """
+    try:
+        img_path = os.path.join(in_folder, filename)
+        out_path = os.path.join(out_folder, output_filename(filename, save_in_tiff))
+
+        # JPEG to JPEG crops can skip the decode/re-encode cycle entirely
+        if lossless and reduce == 1 and not save_in_tiff and filename.endswith(('.jpg', '.jpeg')):
+            if lossless_crop(img_path, out_path, crop_width, crop_height):
+                return None
+
+        # Read and crop the image
+        cropped_img = read_crop(img_path, crop_width, crop_height, reduce)
+        if cropped_img is None:
+            return "could not be read"
+
+        # Save the cropped image
+        if not cv2.imwrite(out_path, cropped_img):
+            return "could not be written to " + out_path
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+def benchmark(in_folder, crop_width=default_crop_width, crop_height=default_crop_height, reduces=(1, 2, 4), repeats=3,
+              lossless=True):
+    """
+    Times the decode+crop step of every read mode on the images of a folder.
+
+    The full decode followed by a slice (reduce=1) is the reference, the speedup of the other
+    modes is reported relative to it. With `lossless` the whole crop_file step of the JPEGs, including
+    writing the crop, is timed once re-encoded and once cut with jpegtran, see `lossless_crop`. This
+    arm is skipped when jpegtran is not installed.
+
+    Returns:
+        dict: Milliseconds per image for every reduce factor, and for 'reencode' and 'lossless'.
+    """
+    paths = [os.path.join(in_folder, filename) for filename in sorted(os.listdir(in_folder))
+             if filename.endswith(('.jpg', '.jpeg', '.png'))]
+    timings = {}
+    for reduce in reduces:
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for img_path in paths:
+                read_crop(img_path, crop_width, crop_height, reduce)
+            best = min(best, time.perf_counter() - start)
+        timings[reduce] = 1000 * best / max(len(paths), 1)
+    for reduce, ms in timings.items():
+        print(f"reduce={reduce}: {ms:.1f} ms per image, speedup x{timings[reduces[0]] / ms:.2f}")
+
+    jpegs = [os.path.basename(img_path) for img_path in paths if img_path.endswith(('.jpg', '.jpeg'))]
+    if lossless and shutil.which('jpegtran') is None:
+        print("jpegtran is not installed, the lossless crop is not timed")
+    elif lossless and jpegs:
+        out_folder = tempfile.mkdtemp()
+        try:
+            for mode in ('reencode', 'lossless'):
+                best = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    for filename in jpegs:
+                        crop_file(filename, in_folder, out_folder, crop_width, crop_height, lossless=mode == 'lossless')
+                    best = min(best, time.perf_counter() - start)
+                timings[mode] = 1000 * best / len(jpegs)
+            # crop_file silently re-encodes the JPEGs jpegtran cannot cut, count them
+            fallbacks = sum(not lossless_crop(os.path.join(in_folder, filename), os.path.join(out_folder, filename),
+                                              crop_width, crop_height) for filename in jpegs)
+        finally:
+            shutil.rmtree(out_folder, ignore_errors=True)
+        print(f"crop and save, re-encoded: {timings['reencode']:.1f} ms per JPEG, lossless: {timings['lossless']:.1f} ms "
+              f"per JPEG, speedup x{timings['reencode'] / timings['lossless']:.2f} "
+              f"({fallbacks} of {len(jpegs)} fell back to re-encoding)")
+    return timings
+
 
 class Cropper:
     """A class for cropping images to a specified size."""
@@ -60,39 +247,68 @@ class Cropper:
         self.crop_height= crop_height
         self.crop_width = crop_width
     
-    def crop_save(self,save_in_tiff=False):
-        """Crops each image in the input directory and saves them to the output directory."""
-        for filename in os.listdir(self.in_folder): 
-            if filename.endswith(('.jpg', '.jpeg', '.png')):
-                # Read the image
-                img_path = os.path.join(self.in_folder, filename)
-                img = cv2.imread(img_path)
-                
-                # Get dimensions of the image
-                height, width = img.shape[:2]
-                
-                # Calculate the coordinates for cropping
-                start_x = max(width // 2 - self.crop_width // 2, 0)
-                end_x = min(start_x + self.crop_width, width)
-                start_y = max(height // 2 - self.crop_height // 2, 0)
-                end_y = min(start_y + self.crop_height, height)
-                
-                # Crop the image
-                cropped_img = img[start_y:end_y, start_x:end_x]
-                
-                # Save the cropped image
-                if not save_in_tiff:
-                    out_path = os.path.join(self.out_folder, filename)
-                    cv2.imwrite(out_path, cropped_img)
-                else:
-                    last_dot_index = filename.rfind(".")
-                    out_path = os.path.join(self.out_folder, filename[:last_dot_index]+".tiff")
-                    cv2.imwrite(out_path, cropped_img)
+    def crop_save(self,save_in_tiff=False,parallel=False,workers=None,reduce=1,lossless=False,incremental=False):
+        """
+        Crops each image in the input directory and saves them to the output directory.
+
+        Args:
+            save_in_tiff (bool): Save the cropped images as .tiff instead of the original format.
+            parallel (bool): Spread the images over a pool of worker processes.
+            workers (int): Number of worker processes, defaults to the number of cores.
+            reduce (int): Decode at 1/2, 1/4 or 1/8 resolution, see `read_crop`. Saves the crops at that resolution.
+            lossless (bool): Crop JPEGs losslessly with jpegtran when it is installed, see `lossless_crop`.
+            incremental (bool): Skip images that are unchanged since the last run with the same settings,
+                tracked by a manifest beside the output directory. The crops of deleted images are removed.
+
+        Returns:
+            list: (filename, error) pairs of the images that could not be cropped.
+        """
+        filenames = [filename for filename in sorted(os.listdir(self.in_folder))
+                     if filename.endswith(('.jpg', '.jpeg', '.png'))]
+        if incremental:
+            manifest = Manifest(self.out_folder, {'crop_width': self.crop_width,
+                                                  'crop_height': self.crop_height,
+                                                  'save_in_tiff': bool(save_in_tiff),
+                                                  'reduce': reduce,
+                                                  'lossless': bool(lossless)})
+            manifest.prune(filenames)
+            total = len(filenames)
+            filenames = [filename for filename in filenames
+                         if not manifest.is_current(filename, os.path.join(self.in_folder, filename))]
+            print(f"Skipping {total - len(filenames)} unchanged images")
+        task = partial(crop_file,
+                       in_folder=self.in_folder,
+                       out_folder=self.out_folder,
+                       crop_width=self.crop_width,
+                       crop_height=self.crop_height,
+                       save_in_tiff=save_in_tiff,
+                       reduce=reduce,
+                       lossless=lossless)
+        
+        if parallel and len(filenames) > 1:
+            workers = min(int(workers or default_workers), len(filenames))
+            # hand out several files per task to keep the inter-process overhead low
+            chunksize = max(1, len(filenames) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                errors = list(executor.map(task, filenames, chunksize=chunksize))
+        else:
+            errors = [task(filename) for filename in filenames]
+        
+        failures = [(filename, error) for filename, error in zip(filenames, errors) if error is not None]
+        if incremental:
+            for filename, error in zip(filenames, errors):
+                if error is None:
+                    manifest.record(filename, os.path.join(self.in_folder, filename), [output_filename(filename, save_in_tiff)])
+            manifest.save()
+        print(f"Cropped {len(filenames) - len(failures)} of {len(filenames)} images to: {self.out_folder}")
+        for filename, error in failures:
+            print(f"Failed to crop {filename}: {error}")
+        return failures
     
-    def run(self,crop_width=default_crop_width,crop_height = default_crop_height,save_in_tiff=False):
+    def run(self,crop_width=default_crop_width,crop_height = default_crop_height,save_in_tiff=False,parallel=False,workers=None,reduce=1,lossless=False,incremental=False):
         """Configures the cropper and initiates the cropping process."""
         self.set_cropping_size(crop_width, crop_height)
-        self.crop_save(save_in_tiff)
+        return self.crop_save(save_in_tiff,parallel=parallel,workers=workers,reduce=reduce,lossless=lossless,incremental=incremental)
 
 def parse_args():
     """Parses command line arguments for cropping images."""
@@ -103,6 +319,12 @@ def parse_args():
     parser.add_argument("--crop_width", type=int, default=1400, help="Width of the cropped image.")
     parser.add_argument("--crop_height", type=int, default=1840, help="Height of the cropped image.")
     parser.add_argument("--save_in_tiff", action="store_true", help="Flag to save the output in TIFF format instead of default PNG.")
+    parser.add_argument("--parallel", action="store_true", help="Crop the images with a pool of worker processes.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes for --parallel (default: number of cores).")
+    parser.add_argument("--reduce", type=int, default=1, choices=[1, 2, 4, 8], help="Decode the images at 1/reduce of their resolution.")
+    parser.add_argument("--lossless", action="store_true", help="Crop JPEGs losslessly with jpegtran if it is installed.")
+    parser.add_argument("--incremental", action="store_true", help="Only crop images that changed since the last run.")
+    parser.add_argument("--benchmark", action="store_true", help="Only time the decode+crop step of every read mode and the lossless JPEG crop on the input folder.")
         
     args = parser.parse_args()
     if not args.interactive_off:
@@ -115,9 +337,10 @@ def parse_interactive_args():
     print("Augment images with specific transformations.")
     in_folder = input("Directory path to the input images: (default: int_img)") or "int_img"
     out_folder = input("Directory path for saving cropped images (default: out_cropped_img): ") or "out_cropped_img"
-    crop_width = input("Enter Width of the cropped image (default 1400): ") or "1400"
-    crop_height = input("Height of the cropped image (default: 1840): ") or "1840"
+    crop_width = int(input("Enter Width of the cropped image (default 1400): ") or "1400")
+    crop_height = int(input("Height of the cropped image (default: 1840): ") or "1840")
     save_in_tiff = input("save in which format,default in the same format as orignal (default: False): ") or False
+    workers = int(input(f"Number of worker processes, 0 to crop sequentially (default: {default_workers}): ") or default_workers)
     class Args:
         def __init__(self):
             self.in_folder = in_folder
@@ -125,14 +348,23 @@ def parse_interactive_args():
             self.crop_width = crop_width
             self.crop_height = crop_height
             self.save_in_tiff = save_in_tiff
+            self.parallel = workers > 0
+            self.workers = workers or None
+            self.reduce = 1
+            self.lossless = False
+            self.incremental = False
+            self.benchmark = False
             self.interactive = True
     return Args()
 
 if __name__ == "__main__":
     args = parse_args()
+    if args.benchmark:
+        benchmark(args.in_folder, args.crop_width, args.crop_height)
+        raise SystemExit
     cropper = Cropper(args.in_folder, args.out_folder)
-    cropper.run(args.crop_width, args.crop_height, args.save_in_tiff)
-    if args.interactive:
+    cropper.run(args.crop_width, args.crop_height, args.save_in_tiff, args.parallel, args.workers, args.reduce, args.lossless, args.incremental)
+    if getattr(args, "interactive", False):
         to_exit = False
         while not to_exit:
             print('current status of Augumentator:')
@@ -141,12 +373,13 @@ if __name__ == "__main__":
             print(f"3. Width of the cropped image: {args.crop_width}")
             print(f"4. Height of the cropped image: {args.crop_height}")
             print(f"5. is output format in tiff?: {args.save_in_tiff}")
-            print("6. excute")
-            print("7. exit")
+            print(f"6. number of worker processes (0 = sequential): {args.workers if args.parallel else 0}")
+            print("7. excute")
+            print("8. exit")
             
             change = int(input("Enter number to select setting you want to change: ") or 0)
             if change == 0:
-                print("no input, enter 7 to exit if you want stop")
+                print("no input, enter 8 to exit if you want stop")
             elif change == 1:
                 args.in_folder = input("Directory path to the input images: (default: int_img)") or args.in_folder
             elif change == 2:
@@ -158,9 +391,12 @@ if __name__ == "__main__":
             elif change == 5:
                 args.save_in_tiff = bool(input("Is output format in tiff? (default: False)") or args.save_in_tiff)
             elif change == 6:
+                workers = int(input(f"Number of worker processes, 0 to crop sequentially: (default: {default_workers})") or default_workers)
+                args.parallel, args.workers = workers > 0, workers or None
+            elif change == 7:
                 execute = bool(int(input("do you really want to run cropping with current setting? 1 for yes and 0 for no: ") or 0))
                 if execute:
                     cropper = Cropper(args.in_folder, args.out_folder)
-                    cropper.run(args.crop_width, args.crop_height, args.save_in_tiff)
-            elif change == 7:
+                    cropper.run(args.crop_width, args.crop_height, args.save_in_tiff, args.parallel, args.workers, args.reduce, args.lossless, args.incremental)
+            elif change == 8:
                 to_exit = 1
\ No newline at end of file
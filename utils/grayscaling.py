@@ -1,8 +1,17 @@
 import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from pathlib import Path
 import argparse
+try:
+    from utils.manifest import Manifest
+except ImportError:  # run as a script from inside utils/
+    from manifest import Manifest
 
 workingDirectory = Path.cwd()
 print(workingDirectory)
@@ -10,6 +19,9 @@ print(workingDirectory)
 default_folderRead = Path('read\PixelLabelData')
 default_folderWrite = Path('write')
 default_numClasses =  2
+default_cache_bytes = 1 << 30  # decoded planes kept between parse_color and color2grey
+default_queue_size = 16  # encoded masks waiting for the writer thread
+image_extensions = ('.jpg', '.jpeg', '.png', 'tiff')
 default_writeDirectory = workingDirectory / default_folderWrite
 default_readDirectory = workingDirectory / default_folderRead
 
@@ -32,11 +44,17 @@ class Grayscaler:
         self.writeDirectory = Path(writeDirectory)
         if not self.writeDirectory.exists():
             os.makedirs(self.writeDirectory)
-        self.img_name_list = sorted(os.listdir(self.readDirectory))
+        self.img_name_list = sorted(img_name for img_name in os.listdir(self.readDirectory)
+                                    if img_name.endswith(image_extensions))
         self.numClasses = numClasses
         self.uniqueColors = set()
+        self.histogram = None
+        self.image_histograms = {}
+        self.manifest = None
+        self.plane_cache = {}
         self.thresholds = None
         self.colorClasses = None
+        self.lut = None
     
     def call_size(self):
         """
@@ -45,17 +63,72 @@ class Grayscaler:
         print('Dataset size: ', len(self.img_name_list))
         return len(self.img_name_list)
     
-    def parse_color(self):
+    def open_manifest(self):
+        """
+        Loads the manifest of the write directory for an incremental run and removes the masks of deleted images.
+        
+        Besides the input and its mask, every entry holds the histogram of the image and the classes its grey
+        values were mapped to, see `iter_color2grey`.
+        """
+        params = {'numClasses': int(self.numClasses)}
+        if self.manifest is None or self.manifest.params != params:
+            self.manifest = Manifest(self.writeDirectory, params)
+            self.manifest.prune(self.img_name_list)
+        return self.manifest
+
+    def parse_color(self, cache_bytes=default_cache_bytes, incremental=False):
         """
         Parses unique grayscale values from the images in the read directory.
+        
+        The values are counted into a global 256-bin histogram (see `save_histogram`). The decoded
+        planes are kept in memory up to `cache_bytes`, so that `color2grey` does not decode them again.
+        With `incremental` the histograms of images unchanged since the last incremental run are taken
+        from the manifest, only new and changed images are decoded.
         """
+        manifest = self.open_manifest() if incremental else None
+        self.histogram = np.zeros(256, dtype=np.int64)
+        self.image_histograms = {}
+        self.plane_cache = {}
+        cached_bytes = 0
         for img_name in self.img_name_list:
             img_path = os.path.join(self.readDirectory, img_name)
+            if manifest is not None and manifest.is_unchanged(img_name, img_path) \
+                    and 'histogram' in manifest.entries[img_name]:
+                stored = manifest.entries[img_name]['histogram']
+                self.histogram[[int(value) for value in stored]] += list(stored.values())
+                continue
             img = cv2.imread(img_path, flags=0)  # Open image in greyscale mode
-            self.uniqueColors |= set(np.unique(img))
+            histogram = np.bincount(img.ravel(), minlength=256)
+            self.histogram += histogram
+            if manifest is not None:
+                # sparse, masks only hold a few grey values
+                self.image_histograms[img_name] = {str(value): int(histogram[value])
+                                                   for value in np.flatnonzero(histogram)}
+            if cached_bytes + img.nbytes <= cache_bytes:
+                self.plane_cache[img_name] = img
+                cached_bytes += img.nbytes
+        if manifest is not None:
+            print(f"Decoded {len(self.image_histograms)} new or changed images")
+        self.uniqueColors = set(np.flatnonzero(self.histogram).tolist())
         print("Found Colors (unique greyscale values [0..255]): ", len(self.uniqueColors))
         return len(self.uniqueColors)
     
+    def save_histogram(self, path=None):
+        """
+        Saves the global histogram of grayscale values as .npy, by default to histogram.npy in the write directory.
+        """
+        path = self.writeDirectory / 'histogram.npy' if path is None else Path(path)
+        np.save(path, self.histogram)
+        return path
+    
+    def load_histogram(self, path):
+        """
+        Loads a histogram saved by `save_histogram`, so `scale_gray` can run without parsing the images again.
+        """
+        self.histogram = np.load(path)
+        self.uniqueColors = set(np.flatnonzero(self.histogram).tolist())
+        return self.histogram
+    
     def scale_gray(self):
         """
         Categorizes the grayscale values using thresholds and generates new grayscale classes.
@@ -72,40 +145,212 @@ class Grayscaler:
         print("New greyscale values: ", self.colorClasses)
         return self.colorClasses
 
-    def color2grey(self):
+    def quantize_per_class(self, img):
         """
-        Applies the thresholds to the images and saves the processed images to the write directory.
+        Maps the grayscale values of an image to the color classes with one `cv2.inRange` pass per class.
+        """
+        output_img = np.zeros_like(img)
+        for i in range(self.numClasses):
+            lower_bound = self.thresholds[i]
+            upper_bound = self.thresholds[i + 1]
+            mask = cv2.inRange(img, lower_bound, upper_bound)
+            output_img[mask > 0] = self.colorClasses[i]
+        return output_img
+
+    def build_lut(self):
+        """
+        Compiles the thresholds and color classes into a 256-entry lookup table.
         
-        :param writeDirectory: Directory to write processed images to.
+        The table is obtained by running `quantize_per_class` over all 256 grayscale values, so applying it
+        gives bit-identical results, including the rounding of the bounds and classes.
         """
-        # Apply thresholds on masks and export to desktop
-        grey_imgs = []
-        for img_name in self.img_name_list:
-            img_path = os.path.join(self.readDirectory, img_name)
-            img = cv2.imread(img_path, flags=0)  # Open image in greyscale mode
-            output_img = np.zeros_like(img)
+        ramp = np.arange(256, dtype=np.uint8).reshape(1, 256)
+        self.lut = self.quantize_per_class(ramp).reshape(256)
+        return self.lut
+
+    def quantize(self, imgs):
+        """
+        Maps the grayscale values to the color classes in one lookup pass.
+        
+        Args:
+            imgs (np.ndarray): A single uint8 image or a stack of images of the same size.
+        """
+        if self.lut is None:
+            self.build_lut()
+        imgs = np.ascontiguousarray(imgs)
+        return cv2.LUT(imgs.reshape(-1, imgs.shape[-1]), self.lut).reshape(imgs.shape)
 
-            for i in range(self.numClasses):
-                lower_bound = self.thresholds[i]
-                upper_bound = self.thresholds[i + 1]
-                mask = cv2.inRange(img, lower_bound, upper_bound)
-                output_img[mask > 0] = self.colorClasses[i]
+    def benchmark_quantization(self, class_counts=(2, 8, 32), num_images=8, repeats=3):
+        """
+        Compares the throughput of `quantize_per_class` and `quantize` for different numbers of classes.
+        
+        The thresholds are spread over the full [0..255] range and the attributes are restored afterwards.
+        
+        Returns:
+            dict: Megapixels per second of both engines for every class count.
+        """
+        imgs = np.stack([cv2.imread(os.path.join(self.readDirectory, img_name), flags=0)
+                         for img_name in self.img_name_list[:num_images]])
+        megapixels = imgs.size / 1e6
+        state = (self.numClasses, self.thresholds, self.colorClasses, self.lut)
+        results = {}
+        try:
+            for numClasses in class_counts:
+                self.numClasses = numClasses
+                self.thresholds = np.linspace(start=0, stop=256, num=numClasses + 1)
+                self.colorClasses = np.linspace(start=0, stop=255, num=numClasses)
+                self.build_lut()
+                timings = {'per_class': float('inf'), 'lut': float('inf'), 'lut_batch': float('inf')}
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    expected = [self.quantize_per_class(img) for img in imgs]
+                    timings['per_class'] = min(timings['per_class'], time.perf_counter() - start)
+                    start = time.perf_counter()
+                    single = [self.quantize(img) for img in imgs]
+                    timings['lut'] = min(timings['lut'], time.perf_counter() - start)
+                    start = time.perf_counter()
+                    batch = self.quantize(imgs)
+                    timings['lut_batch'] = min(timings['lut_batch'], time.perf_counter() - start)
+                assert np.array_equal(np.stack(expected), np.stack(single)) and np.array_equal(np.stack(expected), batch)
+                results[numClasses] = {engine: megapixels / seconds for engine, seconds in timings.items()}
+                print(f"{numClasses} classes: " + ", ".join(f"{engine} {mps:.0f} MP/s" for engine, mps in results[numClasses].items()))
+        finally:
+            self.numClasses, self.thresholds, self.colorClasses, self.lut = state
+        return results
+
+    def quantize_file(self, img_name):
+        """
+        Reads (or takes from the plane cache), quantizes and PNG-encodes one image.
+        
+        Returns:
+            tuple: (mask, encoded png buffer), or None if the image could not be read.
+        """
+        img = self.plane_cache.pop(img_name, None)
+        if img is None:
+            img = cv2.imread(os.path.join(self.readDirectory, img_name), flags=0)  # Open image in greyscale mode
+        if img is None:
+            return None
+        output_img = self.quantize(img)
+        return output_img, cv2.imencode('.png', output_img)[1]
+
+    def iter_color2grey(self, incremental=False, workers=0, queue_size=default_queue_size):
+        """
+        Streaming variant of `color2grey`, yields (name, mask) pairs instead of collecting them.
+        
+        The masks are saved by a writer thread fed through a bounded queue, so at most `queue_size`
+        encoded masks are pending and memory stays flat regardless of the dataset size.
+        
+        :param incremental: See `color2grey`, run `parse_color` with `incremental` as well to only decode the delta.
+        :param workers: Number of threads running the read+quantize+encode step in parallel (0 runs it inline).
+            OpenCV releases the GIL while decoding, looking up and encoding, so threads scale without copying
+            the planes between processes.
+        :param queue_size: Maximum number of encoded masks waiting to be written.
+        """
+        img_name_list = self.img_name_list
+        manifest = None
+        self.build_lut()
+        if incremental:
+            manifest = self.open_manifest()
+
+            def classes(histogram):
+                return [int(self.lut[int(value)]) for value in histogram]
+
+            def is_current(img_name):
+                # a mask stays valid as long as the grey values of its image map to the same classes, even if
+                # the thresholds moved
+                if not manifest.is_current(img_name, os.path.join(self.readDirectory, img_name)):
+                    return False
+                entry = manifest.entries[img_name]
+                return 'classes' in entry and classes(entry['histogram']) == entry['classes']
 
-            output_path = os.path.join(self.writeDirectory, ''+img_name.rsplit('.', 1)[0]+'_masked.png')
-            grey_imgs.append(output_img)
-            cv2.imwrite(output_path, output_img)
+            img_name_list = [img_name for img_name in img_name_list if not is_current(img_name)]
+            print(f"Skipping {len(self.img_name_list) - len(img_name_list)} unchanged images")
+            # histograms to record with the new masks, from parse_color or from the entries of unchanged images
+            histograms = {}
+            for img_name in img_name_list:
+                if img_name in self.image_histograms:
+                    histograms[img_name] = self.image_histograms[img_name]
+                elif manifest.is_unchanged(img_name, os.path.join(self.readDirectory, img_name)) \
+                        and 'histogram' in manifest.entries[img_name]:
+                    histograms[img_name] = manifest.entries[img_name]['histogram']
 
+        write_queue = queue.Queue(maxsize=queue_size)
+        failures = []
+
+        def write():
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                img_name, output_name, buffer = item
+                try:
+                    buffer.tofile(os.path.join(self.writeDirectory, output_name))
+                    if manifest is not None:
+                        histogram = histograms.get(img_name)
+                        extra = {} if histogram is None else {'histogram': histogram, 'classes': classes(histogram)}
+                        manifest.record(img_name, os.path.join(self.readDirectory, img_name), [output_name], **extra)
+                except Exception as e:
+                    failures.append((img_name, repr(e)))
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        try:
+            # keep a bounded number of images in flight ahead of the consumer
+            pending = deque()
+            names = iter(img_name_list)
+            for img_name in names:
+                pending.append((img_name, executor.submit(self.quantize_file, img_name) if executor else None))
+                if len(pending) >= 2 * max(workers, 1):
+                    break
+            while pending:
+                img_name, future = pending.popleft()
+                result = future.result() if future else self.quantize_file(img_name)
+                next_name = next(names, None)
+                if next_name is not None:
+                    pending.append((next_name, executor.submit(self.quantize_file, next_name) if executor else None))
+                if result is None:
+                    failures.append((img_name, "could not be read"))
+                    continue
+                output_img, buffer = result
+                write_queue.put((img_name, img_name.rsplit('.', 1)[0]+'_masked.png', buffer))
+                yield img_name, output_img
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            write_queue.put(None)
+            writer.join()
+            if manifest is not None:
+                manifest.save()
+            self.plane_cache = {}
+            for img_name, error in failures:
+                print(f"Failed to process {img_name}: {error}")
         print("Images processed and saved to:", self.writeDirectory)
-        return grey_imgs
+
+    def color2grey(self, incremental=False, workers=0):
+        """
+        Applies the thresholds to the images and saves the processed images to the write directory.
+        
+        :param incremental: Skip images that are unchanged since the last run and whose grey values still map to the
+            same classes, tracked by a manifest beside the write directory, see `open_manifest`. Skipped images are
+            not part of the returned list, the masks of deleted images are removed.
+        :param workers: Number of threads quantizing and encoding in parallel, see `iter_color2grey`.
+        """
+        # Apply thresholds on masks and export to desktop
+        return [output_img for _, output_img in self.iter_color2grey(incremental, workers)]
         
-    def run(self):
+    def run(self, incremental=False, stream=False, workers=0):
         """
         Initializes the processing by calling the size, color parsing, grayscale scaling, and image processing methods.
+        
+        With `stream` the masks are only written, not collected, and the number of processed images is returned.
         """
         self.call_size()
-        self.parse_color()
+        self.parse_color(incremental=incremental)
         self.scale_gray()
-        return self.color2grey()
+        if stream:
+            return sum(1 for _ in self.iter_color2grey(incremental, workers))
+        return self.color2grey(incremental, workers)
 
 
 
@@ -119,6 +364,10 @@ def parse_args():
     parser.add_argument("--readDirectory", type=str, default="read/PixelLabelData", help="Directory path to read images from.")
     parser.add_argument("--writeDirectory", type=str, default="write", help="Directory path to write processed images to.")
     parser.add_argument("--numClasses", type=int, default=2, help="Number of grayscale classes for image categorization.")
+    parser.add_argument("--incremental", action="store_true", help="Only process images that changed since the last run.")
+    parser.add_argument("--stream", action="store_true", help="Write the masks without keeping them in memory.")
+    parser.add_argument("--workers", type=int, default=0, help="Number of threads quantizing and encoding in parallel.")
+    parser.add_argument("--benchmark", action="store_true", help="Only compare the quantization engines at 2, 8 and 32 classes.")
     args = parser.parse_args()
     if not args.interactive_off:
         args = parse_interactive_args()
@@ -129,12 +378,17 @@ def parse_interactive_args():
     print("Augment images with specific transformations.")
     readDirectory = input("Directory path to the input (labeled) images: (default: read/PixelLabelData") or "read/PixelLabelData"
     writeDirectory = input("Directory path for saving scaled images (default: writeDirectory): ") or "writeDirectory"
-    numClasses = input("Number of grayscale classes for image categorization (default 2): ") or "2"
+    numClasses = int(input("Number of grayscale classes for image categorization (default 2): ") or "2")
     class Args:
         def __init__(self):
             self.readDirectory = readDirectory
             self.writeDirectory = writeDirectory
             self.numClasses = numClasses
+            self.incremental = False
+            self.benchmark = False
+            self.stream = False
+            self.workers = 0
+            self.interactive = True
     return Args()
 
 
@@ -142,8 +396,11 @@ def parse_interactive_args():
 if __name__ == "__main__":
     args = parse_args()
     grayscaler = Grayscaler(args.readDirectory, args.writeDirectory, args.numClasses)
-    grayscaler.run()
-    if args.interactive:
+    if args.benchmark:
+        grayscaler.benchmark_quantization()
+        raise SystemExit
+    grayscaler.run(args.incremental, args.stream, args.workers)
+    if getattr(args, "interactive", False):
         to_exit = False
         while not to_exit:
             print('current status of Augumentator:')
@@ -166,6 +423,6 @@ if __name__ == "__main__":
                 execute = bool(int(input("do you really want to run cropping with current setting? 1 for yes and 0 for no: ") or 0))
                 if execute:
                     grayscaler = Grayscaler(args.readDirectory, args.writeDirectory, args.numClasses)
-                    grayscaler.run()
+                    grayscaler.run(args.incremental, args.stream, args.workers)
             elif change == 5:
                 to_exit = 1
\ No newline at end of file
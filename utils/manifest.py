@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+# the manifest of an output folder lies next to it as .<folder name>.manifest.json, so that readers listing the
+# folder only see the outputs
+default_manifest_suffix = '.manifest.json'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns the sha1 hex digest of the content of a file."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Manifest:
+    """Records which inputs were processed into an output folder, so re-runs only process the delta.
+
+    Every entry stores the hash, size and mtime of an input file and the names of the outputs it
+    produced. The processing parameters are stored once for the whole folder; when they differ from
+    the ones of the last run, all recorded outputs are stale and get deleted.
+    """
+
+    def __init__(self, out_folder, params, suffix=default_manifest_suffix):
+        """
+        Loads the manifest of an output folder.
+
+        Args:
+            out_folder (str): Path to the output directory the manifest belongs to.
+            params (dict): JSON serializable processing parameters of the current run.
+            suffix (str): Suffix of the manifest file, it is stored beside the output directory.
+        """
+        self.out_folder = Path(out_folder)
+        folder = self.out_folder.resolve()
+        self.path = folder.with_name('.' + folder.name + suffix)
+        # round trip through json so that tuples and lists compare equal with the stored ones
+        self.params = json.loads(json.dumps(params))
+        self.entries = {}
+
+        if self.path.exists():
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get('params') == self.params:
+                self.entries = stored.get('entries', {})
+            else:
+                self.invalidate(stored.get('entries', {}))
+
+    def invalidate(self, entries):
+        """Deletes the outputs of the given entries, they were produced with other parameters."""
+        removed = 0
+        for entry in entries.values():
+            for output in entry['outputs']:
+                out_path = self.out_folder / output
+                if out_path.exists():
+                    os.remove(out_path)
+                    removed += 1
+        if entries:
+            print(f"Processing parameters changed, removed {removed} stale outputs from: {self.out_folder}")
+
+    def prune(self, keys):
+        """Drops the entries of inputs that are not among `keys` any more and deletes their outputs."""
+        keys = set(keys)
+        gone = {key: entry for key, entry in self.entries.items() if key not in keys}
+        for key, entry in gone.items():
+            for output in entry['outputs']:
+                out_path = self.out_folder / output
+                if out_path.exists():
+                    os.remove(out_path)
+            del self.entries[key]
+        if gone:
+            print(f"Removed the outputs of {len(gone)} deleted inputs from: {self.out_folder}")
+        return len(gone)
+
+    def is_current(self, key, in_path):
+        """
+        Checks whether an input was already processed with the current parameters.
+
+        Size and mtime are compared first, the content is only hashed when the mtime changed.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if not all((self.out_folder / output).exists() for output in entry['outputs']):
+            return False
+        return self.is_unchanged(key, in_path)
+
+    def is_unchanged(self, key, in_path):
+        """Checks whether an input is the same as when its entry was recorded, whether or not its outputs exist."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        stat = os.stat(in_path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime']:
+            return True
+        if file_hash(in_path) != entry['hash']:
+            return False
+        # touched but unchanged, remember the new mtime to skip hashing next time
+        entry['mtime'] = stat.st_mtime_ns
+        return True
+
+    def record(self, key, in_path, outputs, **extra):
+        """Records that an input was processed into the given output file names, along with JSON serializable
+        `extra` fields of the caller."""
+        stat = os.stat(in_path)
+        self.entries[key] = {'hash': file_hash(in_path),
+                             'size': stat.st_size,
+                             'mtime': stat.st_mtime_ns,
+                             'outputs': list(outputs),
+                             **extra}
+
+    def save(self):
+        """Writes the manifest, going through a temporary file so an interrupted run cannot corrupt it."""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'params': self.params, 'entries': self.entries}, f, indent=1)
+        os.replace(tmp_path, self.path)
@@ -1,19 +1,66 @@
+import abc
 import argparse
+import hashlib
+import json
+import math
 import numpy as np
 import os
+import pickle
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 import cv2
 import tensorflow as tf
+import keras
 from keras.models import Model
-from keras.layers import Input, Conv2D, Conv2DTranspose, MaxPooling2D, Dropout, concatenate
+from keras.layers import Input, Conv2D, Conv2DTranspose, SeparableConv2D, MaxPooling2D, Dropout, concatenate
 from keras.optimizers import Adam
+from keras.export import ExportArchive
 from sklearn.model_selection import train_test_split, ParameterGrid
-from skimage.transform import resize
+from keras.callbacks import Callback
+try:
+    from utils.augumentation import AffinePipeline, pair_files
+except ImportError:  # run as a script from inside utils/
+    from augumentation import AffinePipeline, pair_files
 
 
-from keras.metrics import Accuracy  
-from keras.callbacks import ModelCheckpoint 
-
+default_seed = 42
+default_cache_dir = Path.cwd() / '.tensor_cache'
+# random rotation/flip/translation drawn per sample and epoch, see AffinePipeline.random
+default_augmentation = {'angle_range': (-30, 30), 'pixel_range': (-20, 20), 'flip_probability': 0.5}
+default_checkpoint_dir = 'checkpoints'
+# probability bins of the threshold sweep in WearDetector.evaluate_folder, thresholds are multiples of 1 / bins
+default_threshold_bins = 100
+# decoded samples held by the shuffle stage of the streaming pipeline, see WearDetector.stream_dataset
+default_shuffle_buffer = 256
+# batches read ahead of / waiting behind the model in the streaming predict, see WearDetector.iter_predict
+default_queue_size = 4
+image_extensions = ('.jpg', '.jpeg', '.png', 'tiff')
+# tiles whose grey values deviate less than this in the low-res pre-pass show no tool and are not run through the model
+default_content_threshold = 3.0
+# coarse-to-fine inference: the downscaled pass marks candidates at this low probability, and every candidate box is
+# grown by the margin in full-resolution pixels, both trade speed for recall
+default_coarse_threshold = 0.2
+default_roi_margin = 64
+# images of dataset/imgs the int8 export calibrates its activation ranges on
+default_calibration_samples = 32
+# arguments of WearDetector that grid_search_train passes to the constructor instead of to train
+architecture_params = ('filters', 'dropout_rate', 'depth', 'width', 'separable')
+# dataset of the grid_search_train worker processes, see init_search_worker
+search_dataset = {}
+# sizes the TensorFlow thread pools of this process were set to, see configure_threads
+thread_pools = {}
+# upper bound of the dropout rate of a level, the deeper levels multiply dropout_rate by up to 1 + depth // 2
+max_dropout_rate = 0.5
+# architectures benchmark_variants compares, arguments of WearDetector on top of the default 16->256 U-Net
+default_variants = [{}, {'width': 0.5}, {'width': 0.5, 'separable': True}, {'width': 0.5, 'depth': 3},
+                    {'width': 0.25, 'depth': 3, 'separable': True}]
 
 
 def parse_list(value_str):
@@ -21,6 +68,313 @@ def parse_list(value_str):
     values = value_str.split(',')
     return [float(v) if '.' in v else int(v) for v in values]
 
+def read_resized(path, target_size):
+    """Reads an image in greyscale and resizes it to `target_size` (height, width) as uint8, None if unreadable."""
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return cv2.resize(img, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA)
+
+
+def read_samples(images_dir, masks_dir, pairs, target_size, images=None, masks=None):
+    """
+    Decodes and resizes image/mask pairs in a pool of threads, OpenCV releases the GIL while doing so.
+    
+    Args:
+        pairs (list): (stem, image file name, mask file name) tuples, see `pair_files`.
+        images, masks (np.ndarray): Optional (N, height, width) uint8 arrays to fill, e.g. memory-mapped files.
+    
+    Returns:
+        tuple: The uint8 image and mask stacks.
+    """
+    if images is None:
+        images = np.zeros((len(pairs),) + tuple(target_size), dtype=np.uint8)
+        masks = np.zeros((len(pairs),) + tuple(target_size), dtype=np.uint8)
+
+    def read(id):
+        _, img_name, msk_name = pairs[id]
+        img = read_resized(os.path.join(images_dir, img_name), target_size)
+        mask = read_resized(os.path.join(masks_dir, msk_name), target_size)
+        if img is None or mask is None:
+            raise IOError(f"could not read {img_name if img is None else msk_name}")
+        images[id], masks[id] = img, mask
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(read, range(len(pairs))))
+    return images, masks
+
+
+def load_cached_samples(images_dir, masks_dir, pairs, target_size, cache_dir=default_cache_dir):
+    """
+    Returns the resized uint8 image/mask stacks of `read_samples` memory-mapped from the cache, building it on a miss.
+    
+    The cache key covers the names, sizes and mtimes of all files and the target size, so any change of the
+    folders or the size builds a new entry.
+    """
+    listing = [target_size]
+    for _, img_name, msk_name in pairs:
+        for path in (os.path.join(images_dir, img_name), os.path.join(masks_dir, msk_name)):
+            stat = os.stat(path)
+            listing.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    key = hashlib.sha1(json.dumps(listing).encode()).hexdigest()[:16]
+    entry = Path(cache_dir) / key
+
+    if not (entry / 'masks.npy').exists():
+        print(f"Building tensor cache {entry}")
+        tmp_entry = Path(cache_dir) / (key + '.tmp')
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        shape = (len(pairs),) + tuple(target_size)
+        images = np.lib.format.open_memmap(tmp_entry / 'images.npy', mode='w+', dtype=np.uint8, shape=shape)
+        masks = np.lib.format.open_memmap(tmp_entry / 'masks.npy', mode='w+', dtype=np.uint8, shape=shape)
+        read_samples(images_dir, masks_dir, pairs, target_size, images, masks)
+        images.flush()
+        masks.flush()
+        del images, masks
+        # publish the entry in one step, an interrupted build leaves only the .tmp directory behind
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+    return np.load(entry / 'images.npy', mmap_mode='r'), np.load(entry / 'masks.npy', mmap_mode='r')
+
+
+def to_uint8_mask(prediction):
+    """Scales a predicted mask in [0, 1] to an 8-bit image."""
+    return np.clip(np.rint(np.asarray(prediction) * 255), 0, 255).astype(np.uint8)
+
+
+def tile_origins(length, tile, overlap):
+    """Returns the start offsets of tiles of size `tile` covering `length` with at least `overlap` overlap, the last
+    tile ends flush with the border. An overlap of a whole tile or more advances the tiles by one pixel."""
+    if length <= tile:
+        return [0]
+    count = int(math.ceil((length - overlap) / max(tile - overlap, 1)))
+    return sorted(set(np.linspace(0, length - tile, count).round().astype(int).tolist()))
+
+
+def blend_window(tile_size):
+    """Returns the (height, width) weights tiles are blended with, a 2D Hann window that stays above zero at the
+    border so that pixels covered by a single tile keep their prediction."""
+    rows, cols = (np.hanning(n + 2)[1:-1] for n in tile_size)
+    return np.outer(rows, cols).astype(np.float32)
+
+
+def merge_boxes(boxes):
+    """Merges overlapping (x0, y0, x1, y1) boxes into their bounding boxes until no two boxes overlap."""
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(len(boxes) - 1, i, -1):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+    return [tuple(box) for box in boxes]
+
+
+def measure_throughput(dataset, batches=20):
+    """
+    Iterates over the first `batches` batches of a dataset without training and returns the samples per second.
+    
+    The first batch is not timed, it includes the start-up of the pipeline.
+    """
+    samples, start = 0, None
+    for x, _ in dataset.take(batches + 1):
+        if start is None:
+            start = time.perf_counter()
+            continue
+        samples += int(x.shape[0])
+    elapsed = time.perf_counter() - start if start is not None else 0
+    return samples / elapsed if elapsed > 0 else float('nan')
+
+
+class ThroughputCallback(Callback):
+    """Records the training samples per second of every epoch, the first batch of an epoch is not timed."""
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.rates = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = None
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.start is None:
+            self.start = time.perf_counter()
+        else:
+            self.batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.start is not None and self.batches:
+            self.rates.append(self.batches * self.batch_size / (time.perf_counter() - self.start))
+
+
+class CheckpointCallback(Callback):
+    """
+    Saves a tf.train.Checkpoint every `every` epochs and after the last one, see `WearDetector.train`.
+    
+    The checkpoint holds the weights, the optimizer state, the dropout seed states, the number of finished epochs,
+    the data seed and the last validation loss. Saving only copies the variables into a snapshot, the snapshot is
+    written by a background thread while the next epoch runs, and becomes the latest checkpoint once complete.
+    """
+
+    def __init__(self, model, directory, every=1, seed=default_seed, max_to_keep=3):
+        super().__init__()
+        # the Keras 3 optimizer is not trackable and its variables cannot be copied by TensorFlow's own async
+        # checkpointing, snapshot them into plain variables instead
+        self.live = list(model.variables) + list(model.optimizer.variables)
+        self.snapshot = [tf.Variable(variable.value, trainable=False) for variable in self.live]
+        self.checkpoint = tf.train.Checkpoint(variables=self.snapshot, epoch=tf.Variable(0, dtype=tf.int64),
+                                              seed=tf.Variable(seed, dtype=tf.int64),
+                                              val_loss=tf.Variable(float('nan'), dtype=tf.float64))
+        self.manager = tf.train.CheckpointManager(self.checkpoint, str(directory), max_to_keep=max_to_keep)
+        self.every = every
+        self.epoch = 0
+        self.val_loss = float('nan')
+        self.saved_epoch = 0
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def restore(self):
+        """Loads the latest checkpoint into the model and optimizer, returns its (epoch, seed, validation loss) or
+        None if there is none."""
+        if not self.manager.latest_checkpoint:
+            return None
+        self.checkpoint.restore(self.manager.latest_checkpoint).assert_consumed()
+        for variable, saved in zip(self.live, self.snapshot):
+            variable.assign(saved)
+        self.epoch = self.saved_epoch = int(self.checkpoint.epoch)
+        self.val_loss = float(self.checkpoint.val_loss)
+        return self.epoch, int(self.checkpoint.seed), self.val_loss
+
+    def save(self):
+        # the previous write has to finish before the snapshot is overwritten
+        if self.pending is not None:
+            self.pending.result()
+        for saved, variable in zip(self.snapshot, self.live):
+            saved.assign(variable.value)
+        self.checkpoint.epoch.assign(self.epoch)
+        self.checkpoint.val_loss.assign(self.val_loss)
+        self.saved_epoch = self.epoch
+        self.pending = self.writer.submit(self.manager.save, checkpoint_number=self.epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        self.val_loss = (logs or {}).get('val_loss', float('nan'))
+        if self.epoch % self.every == 0:
+            self.save()
+
+    def on_train_end(self, logs=None):
+        try:
+            if self.epoch != self.saved_epoch:
+                self.save()
+            if self.pending is not None:
+                self.pending.result()
+        finally:
+            self.writer.shutdown(wait=True)
+
+
+def bfloat16_supported():
+    """Returns whether the CPU has bfloat16 instructions (AVX512-BF16 or AMX), without them bfloat16 is emulated."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def configure_threads(intra_op=None, inter_op=None):
+    """
+    Sizes the TensorFlow thread pools: `intra_op` threads parallelize a single operation, one per core by default,
+    `inter_op` threads run independent operations side by side, 2 by default since the U-Net is mostly a chain.
+    Has to run before TensorFlow executes anything, returns False if it is too late.
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op or os.cpu_count())
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op or 2)
+    except RuntimeError:
+        print("TensorFlow is already initialized, the thread pools keep their size")
+        thread_pools['too_late'] = True
+        return False
+    thread_pools.update(intra_op=intra_op or os.cpu_count(), inter_op=inter_op or 2)
+    return True
+
+
+def scores_from_counts(tp, fp, fn):
+    """Returns Dice, IoU, precision and recall of confusion counts, a score without any relevant pixel is 1.0."""
+    tp, fp, fn = int(tp), int(fp), int(fn)
+    return {'dice': 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 1.0,
+            'iou': tp / (tp + fp + fn) if tp + fp + fn else 1.0,
+            'precision': tp / (tp + fp) if tp + fp else 1.0,
+            'recall': tp / (tp + fn) if tp + fn else 1.0}
+
+
+def segmentation_scores(predicted, target):
+    """Returns the Dice coefficient, IoU, precision and recall of two boolean masks (or stacks of masks)."""
+    tp = np.count_nonzero(predicted & target)
+    return scores_from_counts(tp, np.count_nonzero(predicted) - tp, np.count_nonzero(target) - tp)
+
+
+class Backend(abc.ABC):
+    """
+    Base of the exported models that stand in for the Keras model of a WearDetector for inference.
+    
+    Subclasses set `input_shape` and implement `predict_on_batch`, the inference paths of WearDetector use these
+    and `predict`.
+    """
+
+    @abc.abstractmethod
+    def predict_on_batch(self, x):
+        """Returns the (N, height, width, 1) probabilities of a float32 batch in [0, 1]."""
+
+    def predict(self, x, verbose=0, batch_size=16):
+        x = np.asarray(x)
+        return np.concatenate([self.predict_on_batch(x[start:start + batch_size])
+                               for start in range(0, len(x), batch_size)])
+
+
+class TFLiteBackend(Backend):
+    """Runs an exported .tflite WearDetector, see `WearDetector.export_tflite` and `WearDetector.load_tflite`."""
+
+    def __init__(self, file_path=None, num_threads=None, model_content=None):
+        self.interpreter = tf.lite.Interpreter(model_path=None if file_path is None else str(file_path),
+                                               model_content=model_content, num_threads=num_threads or os.cpu_count())
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_shape = (None,) + tuple(input_details['shape'][1:])
+        self.batch_size = int(input_details['shape'][0])
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        # the converted graph has a fixed batch size, run the batch in chunks of it and pad the last one
+        results = []
+        for start in range(0, len(x), self.batch_size):
+            chunk = x[start:start + self.batch_size]
+            padded = np.concatenate([chunk, np.zeros((self.batch_size - len(chunk),) + chunk.shape[1:], np.float32)])
+            self.interpreter.set_tensor(self.input_index, padded)
+            self.interpreter.invoke()
+            results.append(self.interpreter.get_tensor(self.output_index)[:len(chunk)])
+        return np.concatenate(results)
+
+
+class SavedModelBackend(Backend):
+    """Runs an XLA-compiled SavedModel of a WearDetector, see `WearDetector.export_saved_model`."""
+
+    def __init__(self, file_path):
+        self.loaded = tf.saved_model.load(str(file_path))
+        self.input_shape = tuple(self.loaded.serve.input_signature[0].shape)
+
+    def predict_on_batch(self, x):
+        return self.loaded.serve(tf.constant(np.asarray(x, dtype=np.float32))).numpy()
+
+
 class WearDetector(Model):
     """A convolutional neural network model for detecting wear in images using TensorFlow.
 
@@ -30,16 +384,36 @@ class WearDetector(Model):
     Attributes:
         filters (int): Number of filters in the first convolutional layer.
         dropout_rate (float): Dropout rate for the dropout layers.
+        depth (int): Number of pooling levels of the U-Net, the input size must be divisible by 2**depth.
+        width (float): Multiplier of the channels of every level.
+        separable (bool): Use depthwise-separable 3x3 convolutions.
+        jit_compile (bool): Compile the train and predict steps with XLA.
+        mixed_precision (bool): Compute in bfloat16 with float32 weights, the sigmoid output and the loss stay
+            float32. Ignored on CPUs without bfloat16 instructions.
+            Both modes also size the TensorFlow thread pools to the cores with `configure_threads`, unless they
+            were sized before. This only works in the first WearDetector of a process.
         IMG_HEIGHT (int): Height of the input images.
         IMG_WIDTH (int): Width of the input images.
         IMG_CHANNELS (int): Number of channels in the input images.
         model (tf.keras.Model): The underlying Keras model initialized during the build process.
     """
 
-    def __init__(self, filters=16, dropout_rate=0.1, target_size=(512, 512) , IMG_CHANNELS=1):
+    def __init__(self, filters=16, dropout_rate=0.1, target_size=(512, 512) , IMG_CHANNELS=1, depth=4, width=1.0,
+                 separable=False, jit_compile=False, mixed_precision=False):
         super(WearDetector, self).__init__()
+        if not 0 <= dropout_rate < 1:
+            raise ValueError(f"dropout_rate has to be in [0, 1), got {dropout_rate}")
         self.filters = filters
         self.dropout_rate = dropout_rate
+        self.depth = depth
+        self.width = width
+        self.separable = separable
+        self.jit_compile = jit_compile
+        if mixed_precision and not bfloat16_supported():
+            print("The CPU has no bfloat16 instructions, mixed precision is off")
+        self.mixed_precision = mixed_precision and bfloat16_supported()
+        if (jit_compile or mixed_precision) and not thread_pools:
+            configure_threads()
         self.IMG_HEIGHT = target_size[0]
         self.IMG_WIDTH = target_size[1]
         self.IMG_CHANNELS = IMG_CHANNELS
@@ -47,62 +421,58 @@ class WearDetector(Model):
 
 
     def build_model(self):
+        """Builds the U-Net: `depth` pooling levels with `filters` * `width` channels at the top, doubling per level.
         
+        The defaults give the original 16->256 channel network, with dropout_rate, 2 * dropout_rate and
+        3 * dropout_rate in the levels 0-1, 2-3 and 4, capped at max_dropout_rate. With separable=True all 3x3
+        convolutions but the first one are depthwise-separable.
+        """
+        # layers take the global dtype policy when they are created, restore it once the model is built
+        policy = keras.mixed_precision.global_policy()
+        keras.mixed_precision.set_global_policy('mixed_bfloat16' if self.mixed_precision else 'float32')
+        try:
+            self.model = self.build_unet()
+        finally:
+            keras.mixed_precision.set_global_policy(policy)
+        # kept to start over with `reset_weights` instead of building a new model
+        self.initial_weights = self.model.get_weights()
+
+    def build_unet(self):
+        """Returns the Keras U-Net of `build_model`, its layers take the current global dtype policy."""
         inputs = Input((self.IMG_HEIGHT, self.IMG_WIDTH, self.IMG_CHANNELS), name='input_layer')
-        
-        c1 = Conv2D(16, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(inputs)
-        c1 = Dropout(0.1)(c1)
-        c1 = Conv2D(16, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c1)
-        p1 = MaxPooling2D((2, 2))(c1)
+        channels = [max(int(round(self.filters * self.width)), 1) * 2 ** level for level in range(self.depth + 1)]
+        dropouts = [min(round(self.dropout_rate * (1 + level // 2), 6), max_dropout_rate)
+                    for level in range(self.depth + 1)]
 
-        c2 = Conv2D(32, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(p1)
-        c2 = Dropout(0.1)(c2)
-        c2 = Conv2D(32, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c2)
-        p2 = MaxPooling2D((2, 2))(c2)
-            
-        c3 = Conv2D(64, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(p2)
-        c3 = Dropout(0.2)(c3)
-        c3 = Conv2D(64, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c3)
-        p3 = MaxPooling2D((2, 2))(c3)
-            
-        c4 = Conv2D(128, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(p3)
-        c4 = Dropout(0.2)(c4)
-        c4 = Conv2D(128, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c4)
-        p4 = MaxPooling2D(pool_size=(2, 2))(c4)
-            
-        c5 = Conv2D(256, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(p4)
-        c5 = Dropout(0.3)(c5)
-        c5 = Conv2D(256, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c5)
+        def conv(x, n_filters):
+            if self.separable and x is not inputs:
+                return SeparableConv2D(n_filters, (3, 3), activation='relu', depthwise_initializer='he_normal',
+                                       pointwise_initializer='he_normal', padding='same')(x)
+            return Conv2D(n_filters, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(x)
+
+        def block(x, level):
+            x = conv(x, channels[level])
+            x = Dropout(dropouts[level])(x)
+            return conv(x, channels[level])
+
+        #Contracting path
+        skips = []
+        x = inputs
+        for level in range(self.depth):
+            x = block(x, level)
+            skips.append(x)
+            x = MaxPooling2D((2, 2))(x)
+        x = block(x, self.depth)
 
         #Expansive path 
         #DAS IS DECODER STRUKTUR
-        u6 = Conv2DTranspose(128, (2, 2), strides=(2, 2), padding='same')(c5)
-        u6 = concatenate([u6, c4])
-        c6 = Conv2D(128, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(u6)
-        c6 = Dropout(0.2)(c6)
-        c6 = Conv2D(128, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c6)
+        for level in reversed(range(self.depth)):
+            x = Conv2DTranspose(channels[level], (2, 2), strides=(2, 2), padding='same')(x)
+            x = concatenate([x, skips[level]])
+            x = block(x, level)
             
-        u7 = Conv2DTranspose(64, (2, 2), strides=(2, 2), padding='same')(c6)
-        u7 = concatenate([u7, c3])
-        c7 = Conv2D(64, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(u7)
-        c7 = Dropout(0.2)(c7)
-        c7 = Conv2D(64, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c7)
-            
-        u8 = Conv2DTranspose(32, (2, 2), strides=(2, 2), padding='same')(c7)
-        u8 = concatenate([u8, c2])
-        c8 = Conv2D(32, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(u8)
-        c8 = Dropout(0.1)(c8)
-        c8 = Conv2D(32, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c8)
-            
-        u9 = Conv2DTranspose(16, (2, 2), strides=(2, 2), padding='same')(c8)
-        u9 = concatenate([u9, c1], axis=3)
-        c9 = Conv2D(16, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(u9)
-        c9 = Dropout(0.1)(c9)
-        c9 = Conv2D(16, (3, 3), activation='relu', kernel_initializer='he_normal', padding='same')(c9)
-            
-        outputs = Conv2D(1, (1, 1), activation='sigmoid')(c9)
-    
-        self.model = Model(inputs=[inputs], outputs=[outputs])
+        outputs = Conv2D(1, (1, 1), activation='sigmoid', dtype='float32')(x)
+        return Model(inputs=[inputs], outputs=[outputs])
 
     def call(self, inputs):
         return self.model(inputs)
@@ -110,38 +480,85 @@ class WearDetector(Model):
     def compile(self,optimizer='adam', loss='binary_crossentropy', metrics=['accuracy']):
         super().compile(optimizer=optimizer, loss=loss, metrics=metrics)
         
-    def load_data(self,data_path,target_size=(512, 512)):
+    def load_data(self,data_path,target_size=(512, 512),cache_dir=default_cache_dir):
+        """Loads the images and their masks, resized to `target_size`, into self.X and self.y as (N, height, width) uint8.
+        
+        The resized uint8 stacks are cached as .npy files in `cache_dir`, under a key of the file names, sizes and
+        mtimes of both folders and the target size. A warm run memory-maps them instead of decoding anything.
         
+        Args:
+            data_path (dict): Dictionary containing paths to directories of images ('images') and masks ('masks').
+            target_size (tuple): (height, width) the samples are resized to.
+            cache_dir (str): Directory of the cache, None to always decode.
+        """
         images_dir = data_path['images']
         masks_dir = data_path['masks']
-        images = []
-        masks = []
-
-        # Load images and corresponding masks
-        for filename in os.listdir(images_dir):
-            if filename.endswith(('.jpg', '.jpeg', '.png','tiff')):
-                img_path = os.path.join(images_dir, filename)
-                split_filename = filename.split('.')
-                mask_path = os.path.join(masks_dir, split_filename[0] + '_masked.' + split_filename[1]) 
-                # Read the image and mask
-                img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-                mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)  
-                # resize, and optionally convert to TIFF in memory
-                if img is not None and mask is not None:
-                    img = resize(img, target_size)
-                    mask = resize(mask, target_size)
-                images.append(np.array(img))
-                masks.append(np.array(mask))
-                
+        # pair image0000785.jpg with image0000785_masked.jpg
+        pairs = pair_files(images_dir, masks_dir, extensions=('.jpg', '.jpeg', '.png','tiff'))
+        
+        if cache_dir is None:
+            images, masks = read_samples(images_dir, masks_dir, pairs, target_size)
+        else:
+            images, masks = load_cached_samples(images_dir, masks_dir, pairs, target_size, cache_dir)
 
-        # Normalize and prepare dataset
-        self.X = np.array(images, dtype='float32') / 255.0  # normalize images
-        self.y = np.array(masks, dtype='float32') / 255.0  # normalize masks if needed
+        # Keep the dataset as compact uint8, it is normalized to [0, 1] batch by batch in make_dataset
+        self.X = images
+        self.y = masks
         
         self.IMG_HEIGHT = self.X[0].shape[1]
         self.IMG_WIDTH = self.X[0].shape[0]
 
-    def train(self, loss='binary_crossentropy', lr= 0.01,epochs=10, batch_size=10,test_size=0.2, verbose=1, eval=True):
+    def make_dataset(self, indices, batch_size, training=False, augment=None, seed=default_seed, epochs=1, targets=None,
+                     initial_epoch=0):
+        """Builds a tf.data input pipeline over samples of the loaded dataset.
+        
+        Only the samples of the current batches are gathered from self.X/self.y and converted to float32 in [0, 1],
+        so the splits are plain index arrays and the dataset is never copied as a whole.
+        
+        Args:
+            indices (np.ndarray): Indices into self.X/self.y of the samples to use.
+            batch_size (int): Number of samples per batch.
+            training (bool): Yield `epochs` epochs, each in a new order that only depends on `seed` and the epoch.
+            augment (dict): Arguments of `AffinePipeline.random`, or True for `default_augmentation`. Every sample gets
+                a fresh random rotation/flip/translation in every epoch, drawn in the parallel map workers.
+            seed (int): Seed of the shuffling and the augmentation.
+            epochs (int): Number of epochs the training pipeline yields.
+            targets (np.ndarray): (N, height, width) uint8 masks to train on instead of self.y, e.g. soft masks.
+            initial_epoch (int): First epoch of the training pipeline, a continued training sees the same orders and
+                augmentations as an uninterrupted one.
+        """
+        targets = self.y if targets is None else targets
+        if augment is True:
+            augment = default_augmentation
+        indices = tf.constant(np.asarray(indices, dtype=np.int64))
+
+        def load_sample(index, epoch):
+            x, y = self.X[index], targets[index]
+            if augment:
+                pipeline = AffinePipeline.random(np.random.default_rng([seed, epoch, index]), **augment)
+                x, y = pipeline.apply(x), pipeline.apply_mask(y)
+            return x[..., None], y[..., None]
+
+        def normalize(x, y):
+            x = tf.ensure_shape(x, (None,) + self.X.shape[1:] + (1,))
+            y = tf.ensure_shape(y, (None,) + targets.shape[1:] + (1,))
+            return tf.cast(x, tf.float32) / 255.0, tf.cast(y, tf.float32) / 255.0
+
+        def load_batches(order, epoch):
+            dataset = tf.data.Dataset.from_tensor_slices(order)
+            dataset = dataset.map(lambda index: tf.numpy_function(load_sample, [index, epoch], [tf.uint8, tf.uint8]),
+                                  num_parallel_calls=tf.data.AUTOTUNE)
+            return dataset.batch(batch_size).map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+
+        if not training:
+            return load_batches(indices, tf.constant(0, tf.int64)).prefetch(tf.data.AUTOTUNE)
+        epochs = tf.data.Dataset.range(initial_epoch, epochs)
+        dataset = epochs.flat_map(lambda epoch: load_batches(
+            tf.random.experimental.stateless_shuffle(indices, seed=tf.stack([tf.constant(seed, tf.int64), epoch])), epoch))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def train(self, loss='binary_crossentropy', lr= 0.01,epochs=10, batch_size=10,test_size=0.2, verbose=1, eval=True, augment=None, targets=None,
+              initial_epoch=0, workers=1, checkpoint_dir=None, checkpoint_every=1, resume=False, seed=default_seed):
         """Trains the model on provided data, splits it into training and testing datasets.
         
         Args:
@@ -150,22 +567,254 @@ class WearDetector(Model):
             epochs (int): Number of epochs to train the model.
             batch_size (int): Number of samples per batch of computation.
             verbose (int): Verbosity mode.
+            augment (dict): Augment the training samples on the fly, see `make_dataset`. No augmented files are written.
+            targets (np.ndarray): Masks to train and validate on instead of self.y, the test set is always scored
+                against self.y, see `distill`.
+            initial_epoch (int): Epoch to continue a training at, `epochs` is the total number of epochs.
+            workers (int): Train in this many data-parallel processes, see `train_distributed`.
+            checkpoint_dir (str): Save a checkpoint in this directory every `checkpoint_every` epochs and after the
+                last one, see `CheckpointCallback`. The 3 newest are kept.
+            resume (bool): Continue from the latest checkpoint of `checkpoint_dir` (default_checkpoint_dir if None)
+                with its weights, optimizer state, epoch and seed, so the remaining epochs see the same batches and
+                augmentations as in an uninterrupted run. Starts from scratch if there is no checkpoint.
+            seed (int): Seed of the split, the shuffling and the augmentation.
+        
+        Returns:
+            float: Validation loss after the last epoch.
         """
+        if workers > 1:
+            if targets is not None or initial_epoch or checkpoint_dir or resume:
+                raise ValueError("distributed training supports neither replacement targets, initial epochs nor checkpoints")
+            return self.train_distributed(workers, loss, lr, epochs, batch_size, test_size, verbose, eval, augment)
+
+        self.prepare_training(loss, lr)
+        callbacks = []
+        if checkpoint_dir or resume:
+            # create the optimizer slots up front so a checkpoint can restore them
+            self.model.optimizer.build(self.model.trainable_variables)
+            checkpointer = CheckpointCallback(self.model, checkpoint_dir or default_checkpoint_dir, checkpoint_every,
+                                              seed)
+            restored = checkpointer.restore() if resume else None
+            if restored:
+                initial_epoch, seed, val_loss = restored
+                print(f"Resuming from {checkpointer.manager.latest_checkpoint} at epoch {initial_epoch}")
+                if initial_epoch >= epochs:
+                    print(f"The checkpoint already has {initial_epoch} epochs, nothing to train")
+                    return val_loss
+            callbacks.append(checkpointer)
+
         # Split dataset
-        X_train, X_test,y_train, y_test = train_test_split(self.X, self.y, test_size=test_size, random_state=42)      
+        train_idx, val_idx, test_idx = self.split_indices(test_size, seed=seed)
         
         # Train the model
-        optimizer=Adam(learning_rate=lr)
-        self.compile(optimizer=optimizer, loss=loss, metrics=self.model.compile(optimizer=optimizer, loss="categorical_crossentropy", metrics=['accuracy']))
-        history = self.model.fit(X_train, y_train, epochs=epochs, batch_size=batch_size, verbose=verbose, validation_split=0.2)
+        history = self.model.fit(self.make_dataset(train_idx, batch_size, training=True, augment=augment, seed=seed,
+                                                   epochs=epochs, targets=targets, initial_epoch=initial_epoch),
+                                 epochs=epochs, initial_epoch=initial_epoch,
+                                 steps_per_epoch=int(math.ceil(len(train_idx) / batch_size)),
+                                 validation_data=self.make_dataset(val_idx, batch_size, targets=targets),
+                                 callbacks=callbacks, verbose=verbose)
         print("Training complete with final accuracy: {:.2f}%".format(history.history['accuracy'][-1] * 100))
 
         # Optionally, evaluate on test set
         if eval:
-            self.evaluate(X_test, y_test)
+            self.evaluate(self.make_dataset(test_idx, batch_size))
+        return history.history['val_loss'][-1]
+
+    def teacher_masks(self, teacher, batch_size=16, cache_dir=default_cache_dir):
+        """
+        Returns the soft masks a teacher WearDetector predicts for self.X as (N, height, width) uint8.
+        
+        They are cached as .npy in `cache_dir` under a key of the teacher weights and the loaded images, so a
+        teacher runs over a dataset only once. Teachers of another input size see resized images.
+        """
+        sha = hashlib.sha1()
+        for weights in teacher.model.get_weights():
+            sha.update(np.ascontiguousarray(weights).tobytes())
+        for start in range(0, len(self.X), 256):
+            sha.update(np.ascontiguousarray(self.X[start:start + 256]).tobytes())
+        path = Path(cache_dir) / f"teacher-{sha.hexdigest()[:16]}.npy"
+        if path.exists():
+            return np.load(path, mmap_mode='r')
+
+        print(f"Caching teacher masks in {path}")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        masks = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=self.X.shape)
+        teacher_h, teacher_w = teacher.model.input_shape[1:3]
+        for start in range(0, len(self.X), batch_size):
+            imgs = [cv2.resize(img, (teacher_w, teacher_h), interpolation=cv2.INTER_AREA)
+                    for img in self.X[start:start + batch_size]]
+            result = np.asarray(teacher.model.predict_on_batch(np.stack(imgs)[..., None].astype(np.float32) / 255.0))
+            for id, mask in enumerate(result[..., 0]):
+                masks[start + id] = cv2.resize(to_uint8_mask(mask), (self.X.shape[2], self.X.shape[1]),
+                                               interpolation=cv2.INTER_LINEAR)
+        masks.flush()
+        del masks
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def distill(self, teacher, alpha=0.5, loss='binary_crossentropy', lr=0.01, epochs=10, batch_size=10, test_size=0.2,
+                verbose=1, eval=True, augment=None, cache_dir=default_cache_dir):
+        """
+        Trains this model as the student of a larger teacher WearDetector on the loaded data, see `train`.
+        
+        The student learns alpha * ground truth + (1 - alpha) * teacher soft masks. For binary cross-entropy,
+        which is linear in the target, this equals the weighted sum of the losses against both, and the student is
+        compiled with a plain Keras loss, so it is saved and reloaded with `save_model`/`load_model` as usual.
+        The training accuracy compares against the soft targets and means little, the test set is scored against
+        the ground truth.
+        
+        Args:
+            teacher (WearDetector): Trained teacher, e.g. loaded with `load_model`.
+            alpha (float): Weight of the ground truth, 1 ignores the teacher.
+            cache_dir (str): Directory the teacher masks are cached in, see `teacher_masks`.
+        """
+        soft = self.teacher_masks(teacher, cache_dir=cache_dir)
+        targets = np.empty(self.y.shape, dtype=np.uint8)
+        for start in range(0, len(targets), 256):
+            blended = alpha * self.y[start:start + 256].astype(np.float32) + (1 - alpha) * soft[start:start + 256]
+            targets[start:start + 256] = np.rint(blended)
+        return self.train(loss, lr, epochs, batch_size, test_size, verbose, eval, augment, targets=targets)
 
-    def evaluate(self, X,y, verbose=1):
-        """Evaluates the model on provided testing data and prints the accuracy."""
+    def prepare_training(self, loss, lr):
+        """Compiles the model for a training with a fresh Adam optimizer.
+        
+        A model that is already compiled with the same loss is not compiled again: the optimizer state is zeroed and
+        the learning rate assigned, so `fit` keeps the train step it traced before instead of tracing a new one.
+        """
+        if getattr(self, 'compiled_for', None) == (id(self.model), loss, self.jit_compile):
+            optimizer = self.model.optimizer
+            for variable in optimizer.variables:
+                variable.assign(np.zeros(variable.shape, variable.dtype))
+            optimizer.learning_rate = lr
+            return
+        optimizer=Adam(learning_rate=lr)
+        self.compile(optimizer=optimizer, loss=loss)
+        self.model.compile(optimizer=optimizer, loss=loss, metrics=['accuracy'], jit_compile=self.jit_compile)
+        self.compiled_for = (id(self.model), loss, self.jit_compile)
+
+    def reset_weights(self):
+        """Restores the weights the model was built or loaded with, a cheap way to start another training over."""
+        self.model.set_weights(self.initial_weights)
+
+    def stream_dataset(self, data_path, pairs=None, batch_size=10, target_size=None, training=False,
+                       shuffle_buffer=default_shuffle_buffer, cache=False, seed=default_seed):
+        """Builds a tf.data input pipeline that reads image/mask pairs straight from the folders `load_data` uses.
+        
+        Nothing is loaded up front: the files are decoded and resized to uint8 in a parallel map stage, batches are
+        normalized to float32 in [0, 1] and prefetched, so reading overlaps with the training step.
+        
+        Args:
+            data_path (dict): Dictionary containing paths to directories of images ('images') and masks ('masks').
+            pairs (list): (stem, image file name, mask file name) tuples to read, all pairs of the folders if None.
+            batch_size (int): Number of samples per batch.
+            target_size (tuple): (height, width) the samples are resized to, the input size of the model if None.
+            training (bool): Shuffle the samples again in every epoch.
+            shuffle_buffer (int): Number of decoded samples the shuffle stage holds, bounds its memory.
+            cache (bool or str): Cache the decoded samples after the first epoch, in memory if True or in files
+                with this prefix if a path.
+            seed (int): Seed of the shuffling.
+        """
+        images_dir = data_path['images']
+        masks_dir = data_path['masks']
+        if pairs is None:
+            pairs = pair_files(images_dir, masks_dir, extensions=('.jpg', '.jpeg', '.png', 'tiff'))
+        target_size = tuple(target_size or (self.IMG_HEIGHT, self.IMG_WIDTH))
+
+        def load_sample(img_path, msk_path):
+            img = read_resized(img_path.decode(), target_size)
+            mask = read_resized(msk_path.decode(), target_size)
+            if img is None or mask is None:
+                raise IOError(f"could not read {(img_path if img is None else msk_path).decode()}")
+            return img[..., None], mask[..., None]
+
+        def normalize(x, y):
+            x = tf.ensure_shape(x, (None,) + target_size + (1,))
+            y = tf.ensure_shape(y, (None,) + target_size + (1,))
+            return tf.cast(x, tf.float32) / 255.0, tf.cast(y, tf.float32) / 255.0
+
+        dataset = tf.data.Dataset.from_tensor_slices(([os.path.join(images_dir, img) for _, img, _ in pairs],
+                                                      [os.path.join(masks_dir, msk) for _, _, msk in pairs]))
+        if training and not cache:
+            # the file names are cheap to shuffle in full, the bounded buffer below only mixes decoded samples
+            dataset = dataset.shuffle(len(pairs), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.map(lambda img, msk: tf.numpy_function(load_sample, [img, msk], [tf.uint8, tf.uint8]),
+                              num_parallel_calls=tf.data.AUTOTUNE, deterministic=not training)
+        if cache:
+            dataset = dataset.cache('' if cache is True else str(cache))
+        if training:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size).map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def train_stream(self, data_path, loss='binary_crossentropy', lr=0.01, epochs=10, batch_size=10,
+                     validation_size=0.2, target_size=None, shuffle_buffer=default_shuffle_buffer, cache=False,
+                     verbose=1, seed=default_seed):
+        """Trains the model on samples streamed from the folders, see `stream_dataset`, the dataset is never loaded.
+        
+        The input pipeline is timed on its own before the training and compared with the training throughput: if it
+        delivers clearly more samples per second than the training step consumes, loading is not the bottleneck.
+        
+        Args:
+            data_path (dict): Dictionary containing paths to directories of images ('images') and masks ('masks').
+            validation_size (float): Fraction of the pairs held out for validation.
+            target_size (tuple): (height, width) the samples are resized to, the input size of the model if None.
+            shuffle_buffer (int): Number of decoded samples the shuffle stage holds.
+            cache (bool or str): Cache the decoded samples, see `stream_dataset`.
+        
+        Returns:
+            dict: Samples per second of the input pipeline alone and of the training.
+        """
+        pairs = pair_files(data_path['images'], data_path['masks'], extensions=('.jpg', '.jpeg', '.png', 'tiff'))
+        train_idx, val_idx = train_test_split(np.arange(len(pairs)), test_size=validation_size, random_state=seed)
+        train_pairs = [pairs[i] for i in sorted(train_idx)]
+        val_pairs = [pairs[i] for i in sorted(val_idx)]
+        train_ds = self.stream_dataset(data_path, train_pairs, batch_size, target_size, training=True,
+                                       shuffle_buffer=shuffle_buffer, cache=cache, seed=seed)
+        val_ds = self.stream_dataset(data_path, val_pairs, batch_size, target_size)
+
+        # time a fresh pipeline, timing train_ds would fill its cache with a partial epoch
+        pipeline_rate = measure_throughput(self.stream_dataset(data_path, train_pairs, batch_size, target_size,
+                                                               training=True, shuffle_buffer=shuffle_buffer,
+                                                               seed=seed))
+
+        self.prepare_training(loss, lr)
+        throughput = ThroughputCallback(batch_size)
+        history = self.model.fit(train_ds, epochs=epochs, validation_data=val_ds, callbacks=[throughput],
+                                 verbose=verbose)
+        print("Training complete with final accuracy: {:.2f}%".format(history.history['accuracy'][-1] * 100))
+
+        # the first epoch traces the model and fills the cache, report the steady state
+        train_rate = np.mean(throughput.rates[1:] or throughput.rates) if throughput.rates else float('nan')
+        print(f"Input pipeline: {pipeline_rate:.1f} samples/s, training: {train_rate:.1f} samples/s "
+              f"({'training step' if pipeline_rate > train_rate else 'input pipeline'} is the bottleneck)")
+        return {'pipeline': pipeline_rate, 'training': train_rate}
+
+    def split_indices(self, test_size=0.2, validation_size=0.2, seed=default_seed):
+        """Splits the sample indices into training, validation and test indices, the samples themselves are not copied.
+        
+        The test samples are the ones `train_test_split` picks with random_state=seed, the validation samples are the
+        last `validation_size` of the remaining ones, like the validation_split of `fit` used to pick them.
+        """
+        train_idx, test_idx = train_test_split(np.arange(len(self.X)), test_size=test_size, random_state=seed)
+        val_count = int(math.ceil(validation_size * len(train_idx)))
+        if val_count >= len(train_idx):
+            raise ValueError(f"{len(self.X)} samples leave no training samples at test_size={test_size} and "
+                             f"validation_size={validation_size}")
+        return train_idx[:len(train_idx) - val_count], train_idx[len(train_idx) - val_count:], test_idx
+
+    def evaluate(self, X,y=None, verbose=1):
+        """Evaluates the model on provided testing data (arrays, or a dataset of batches with y=None) and prints the accuracy.
+        
+        Given the paths of an image and a mask folder, the segmentation metrics of `evaluate_folder` are reported instead.
+        """
+        if isinstance(X, (str, os.PathLike)):
+            return self.evaluate_folder({'images': X, 'masks': y}, verbose=verbose)
+        if isinstance(X, np.ndarray):
+            if X.dtype == np.uint8:
+                X, y = X.astype(np.float32) / 255.0, np.asarray(y, dtype=np.float32) / 255.0
+            if X.ndim == 3:
+                X, y = X[..., None], y[..., None]
         results = self.model.evaluate(X, y, verbose=verbose)
         print(f"Evaluation results - Loss: {results[0]}, Accuracy: {results[1]*100:.2f}%")
     '''
@@ -185,41 +834,408 @@ class WearDetector(Model):
     ''' 
         
 
-    def predict(self, images_dir, verbose=0,target_size=(512, 512),save_path=False,save_in_tiff=False):
+    def evaluate_folder(self, data_path, batch_size=16, target_size=None, threshold=0.5, bins=default_threshold_bins,
+                        report_path=None, verbose=1):
+        """
+        Scores the predicted masks of a folder of image/mask pairs, streamed batch by batch, see `stream_dataset`.
+        
+        Only counts are kept: the confusion counts at `threshold`, the per-image counts and scores, and a histogram
+        of the predicted probabilities of the wear and of the background pixels. Summing the histograms from a bin
+        upwards gives the confusion counts at every threshold k / bins, so the threshold sweep takes the same single
+        pass over the data.
+        
+        Args:
+            data_path (dict): Dictionary containing paths to directories of images ('images') and masks ('masks').
+            target_size (tuple): (height, width) the pairs are resized to, the input size of the model if None.
+            threshold (float): Probability from which a pixel counts as wear.
+            bins (int): Number of probability bins of the threshold sweep.
+            report_path (str): Write the report as JSON to this file.
+        
+        Returns:
+            dict: The report: counts and scores at `threshold`, the sweep and the threshold of the best Dice, and
+                the per-image statistics.
+        """
+        pairs = pair_files(data_path['images'], data_path['masks'], extensions=image_extensions)
+        dataset = self.stream_dataset(data_path, pairs, batch_size, target_size)
+        wear_histogram = np.zeros(bins, dtype=np.int64)
+        background_histogram = np.zeros(bins, dtype=np.int64)
+        counts = np.zeros(3, dtype=np.int64)
+        per_image = []
+        names = iter(pairs)
+        start = time.perf_counter()
+        for x, y in dataset:
+            probabilities = np.asarray(self.model.predict_on_batch(x))[..., 0]
+            target = y.numpy()[..., 0] > 0.5
+            binned = np.minimum((probabilities * bins).astype(np.int64), bins - 1)
+            wear_histogram += np.bincount(binned[target], minlength=bins)
+            background_histogram += np.bincount(binned[~target], minlength=bins)
+            predicted = probabilities >= threshold
+            for image_predicted, image_target in zip(predicted, target):
+                tp = np.count_nonzero(image_predicted & image_target)
+                fp = np.count_nonzero(image_predicted) - tp
+                fn = np.count_nonzero(image_target) - tp
+                counts += (tp, fp, fn)
+                per_image.append({'name': next(names)[1], 'tp': tp, 'fp': fp, 'fn': fn,
+                                  'wear_pixels': tp + fn, 'predicted_pixels': tp + fp,
+                                  **scores_from_counts(tp, fp, fn)})
+        elapsed = time.perf_counter() - start
+
+        pixels = int(wear_histogram.sum() + background_histogram.sum())
+        tp, fp, fn = (int(count) for count in counts)
+        # confusion counts of "probability >= k / bins" for every k
+        wear_above = np.cumsum(wear_histogram[::-1])[::-1]
+        background_above = np.cumsum(background_histogram[::-1])[::-1]
+        sweep = [{'threshold': k / bins,
+                  **scores_from_counts(wear_above[k], background_above[k], wear_histogram.sum() - wear_above[k])}
+                 for k in range(bins)]
+        best = max(sweep, key=lambda entry: entry['dice'])
+        report = {'images': len(per_image), 'pixels': pixels, 'threshold': threshold,
+                  'tp': tp, 'fp': fp, 'fn': fn, 'tn': pixels - tp - fp - fn,
+                  **scores_from_counts(tp, fp, fn),
+                  'accuracy': (pixels - fp - fn) / pixels if pixels else 1.0,
+                  'mean_image_dice': float(np.mean([image['dice'] for image in per_image])) if per_image else 1.0,
+                  'best_threshold': best['threshold'], 'best_dice': best['dice'],
+                  'images_per_s': len(per_image) / max(elapsed, 1e-9),
+                  'sweep': sweep, 'per_image': per_image}
+        if verbose:
+            print("Evaluation of {images} images - IoU: {iou:.4f}, Dice: {dice:.4f}, Precision: {precision:.4f}, "
+                  "Recall: {recall:.4f} at threshold {threshold}, best Dice {best_dice:.4f} at threshold "
+                  "{best_threshold:.2f}".format(**report))
+        if report_path:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=1)
+        return report
+
+    def predict(self, images_dir, verbose=0,target_size=(512, 512),save_path=False,save_in_tiff=False,stream=False,batch_size=16):
+        """Predicts the masks of all images in a folder and optionally saves them as 8-bit masks in `save_path`.
+        
+        With stream=True the folder is processed batch by batch at constant memory, see `predict_stream`, and the
+        names of the predicted images are returned instead of the stacked predictions.
+        """
+        if stream:
+            return self.predict_stream(images_dir, save_path, target_size, batch_size, save_in_tiff, verbose=verbose)
         images = []
         names = []
         # Load images and corresponding masks
         for filename in os.listdir(images_dir):
-            if filename.endswith(('.jpg', '.jpeg', '.png','tiff')):
+            if filename.endswith(image_extensions):
                 img_path = os.path.join(images_dir, filename)
-                img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-
-                # resize
-                img = resize(img, target_size)
+                img = read_resized(img_path, target_size)
+                if img is None:
+                    continue
 
-                images.append(np.array(img, dtype=np.uint8))
+                images.append(img)
                 names.append(filename)
         images= np.array(images, dtype='float32') / 255.0 
         # Convert list of images to 4D numpy array
         images = np.expand_dims(np.array(images), axis=-1)
         result = self.model.predict(images, verbose=verbose)
         if save_path:
-            img_extension = ".tiff" if save_in_tiff else ""
             if not os.path.exists(Path(save_path)):
                 os.makedirs(save_path)
             for id, img in enumerate(result):
-                img_filename = "prediction"  +"_"+ names[id] + img_extension
-                cv2.imwrite(str(Path(save_path) / img_filename), img)
+                cv2.imwrite(str(Path(save_path) / self.prediction_filename(names[id], save_in_tiff)), to_uint8_mask(img))
         return result
+
+    @staticmethod
+    def prediction_filename(filename, save_in_tiff=False):
+        """Returns the file name a prediction of `filename` is saved under."""
+        return "prediction"  +"_"+ filename + (".tiff" if save_in_tiff else "")
+
+    def iter_predict(self, images_dir, target_size=None, batch_size=16, workers=None, queue_size=default_queue_size,
+                     failures=None):
+        """
+        Streams the predictions of all images in a folder, yields (file name, mask) pairs in file name order.
+        
+        A reader thread decodes and resizes the images of the next batches in a pool of `workers` threads while the
+        model runs on the current one. At most `queue_size` batches wait in between, so memory does not grow with
+        the folder size.
+        
+        Args:
+            images_dir (str): Directory of the images.
+            target_size (tuple): (height, width) the images are resized to, the input size of the model if None.
+            batch_size (int): Number of images per model call.
+            workers (int): Number of decoding threads, os.cpu_count() if None.
+            queue_size (int): Maximum number of decoded batches waiting for the model.
+            failures (list): Collects the names of unreadable images, they are skipped.
+        """
+        target_size = tuple(target_size or (self.IMG_HEIGHT, self.IMG_WIDTH))
+        names = sorted(name for name in os.listdir(images_dir) if name.endswith(image_extensions))
+        read_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            # give up once the consumer is gone, it no longer drains the queue
+            while not stop.is_set():
+                try:
+                    read_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            try:
+                with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+                    for start in range(0, len(names), batch_size):
+                        if stop.is_set():
+                            return
+                        batch_names = names[start:start + batch_size]
+                        put((batch_names, list(executor.map(
+                            lambda name: read_resized(os.path.join(images_dir, name), target_size), batch_names))))
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = read_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch_names, imgs = item
+                readable = [(name, img) for name, img in zip(batch_names, imgs) if img is not None]
+                if failures is not None:
+                    failures.extend(name for name, img in zip(batch_names, imgs) if img is None)
+                if not readable:
+                    continue
+                x = np.stack([img for _, img in readable]).astype(np.float32)[..., None] / 255.0
+                result = np.asarray(self.model.predict_on_batch(x))
+                for (name, _), mask in zip(readable, result):
+                    yield name, mask[..., 0]
+        finally:
+            stop.set()
+            reader.join()
+
+    def predict_stream(self, images_dir, save_path, target_size=None, batch_size=16, save_in_tiff=False, workers=None,
+                       queue_size=default_queue_size, verbose=0):
+        """
+        Predicts all images in a folder and saves the masks as they come, at constant memory, see `iter_predict`.
+        
+        The masks are encoded and written by `workers` writer threads fed through a bounded queue, so encoding
+        overlaps the model as well.
+        
+        Returns:
+            list: Names of the predicted images.
+        """
+        workers = workers or os.cpu_count()
+        os.makedirs(save_path, exist_ok=True)
+        write_queue = queue.Queue(maxsize=queue_size * batch_size)
+        failures = []
+
+        def write():
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                name, mask = item
+                try:
+                    if not cv2.imwrite(str(Path(save_path) / self.prediction_filename(name, save_in_tiff)),
+                                       to_uint8_mask(mask)):
+                        failures.append(name)
+                except Exception:
+                    failures.append(name)
+
+        writers = [threading.Thread(target=write, daemon=True) for _ in range(workers)]
+        for writer in writers:
+            writer.start()
+        names = []
+        start = time.perf_counter()
+        try:
+            for name, mask in self.iter_predict(images_dir, target_size, batch_size, workers, queue_size, failures):
+                write_queue.put((name, mask))
+                names.append(name)
+                if verbose and len(names) % (batch_size * 10) == 0:
+                    print(f"{len(names)} images predicted")
+        finally:
+            for _ in writers:
+                write_queue.put(None)
+            for writer in writers:
+                writer.join()
+        elapsed = time.perf_counter() - start
+        print(f"Predicted {len(names)} images in {elapsed:.1f}s ({len(names) / max(elapsed, 1e-9):.1f} images/s)")
+        if failures:
+            print(f"Failed to read or write {len(failures)} images: {failures[:10]}")
+        return names
     
+    def tile_overlap(self, overlap):
+        """Returns the overlap tiles are predicted with: `overlap`, or a quarter of the tile size if `overlap` does not
+        fit into a tile, e.g. the default 128 pixels on a 128x128 model."""
+        if overlap < 0:
+            raise ValueError(f"overlap {overlap} has to be at least 0")
+        tile = min(self.IMG_HEIGHT, self.IMG_WIDTH)
+        return overlap if overlap < tile else tile // 4
+
+    def predict_full_resolution(self, img, overlap=128, batch_size=16, content_threshold=default_content_threshold,
+                                pre_scale=8, stats=None):
+        """
+        Predicts the mask of an image at its own resolution from overlapping tiles of the model input size.
+        
+        The tiles are run through the model in batches and blended into one probability map with `blend_window`,
+        so the seams between tiles do not show. A pre-pass over the image downscaled by `pre_scale` skips tiles
+        without tool content: their grey values hardly vary, and they are predicted as background.
+        
+        Args:
+            img (np.ndarray): (height, width) uint8 greyscale image, e.g. a whole 1400x1840 crop.
+            overlap (int): Minimum overlap of neighbouring tiles in pixels, see `tile_overlap`.
+            batch_size (int): Number of tiles per model call.
+            content_threshold (float): Tiles whose standard deviation in the pre-pass is below this are skipped,
+                0 runs every tile.
+            pre_scale (int): Downscale factor of the pre-pass.
+            stats (dict): Counts the 'tiles' and the 'skipped' tiles.
+        
+        Returns:
+            np.ndarray: (height, width) float32 probability map.
+        """
+        tile_h, tile_w = self.IMG_HEIGHT, self.IMG_WIDTH
+        overlap = self.tile_overlap(overlap)
+        height, width = img.shape[:2]
+        # images smaller than a tile are padded and cropped again at the end
+        padded = cv2.copyMakeBorder(img, 0, max(tile_h - height, 0), 0, max(tile_w - width, 0), cv2.BORDER_REFLECT)
+        window = blend_window((tile_h, tile_w))
+        probabilities = np.zeros(padded.shape[:2], dtype=np.float32)
+        weights = np.zeros(padded.shape[:2], dtype=np.float32)
+
+        small = cv2.resize(padded, (max(padded.shape[1] // pre_scale, 1), max(padded.shape[0] // pre_scale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        tiles = []
+        skipped = 0
+        for y in tile_origins(padded.shape[0], tile_h, overlap):
+            for x in tile_origins(padded.shape[1], tile_w, overlap):
+                weights[y:y + tile_h, x:x + tile_w] += window
+                region = small[y // pre_scale:(y + tile_h) // pre_scale, x // pre_scale:(x + tile_w) // pre_scale]
+                if content_threshold > 0 and region.size and region.std() < content_threshold:
+                    skipped += 1
+                    continue
+                tiles.append((y, x))
+        if stats is not None:
+            stats['tiles'] = stats.get('tiles', 0) + len(tiles) + skipped
+            stats['skipped'] = stats.get('skipped', 0) + skipped
+
+        for start in range(0, len(tiles), batch_size):
+            batch = tiles[start:start + batch_size]
+            x_batch = np.stack([padded[y:y + tile_h, x:x + tile_w] for y, x in batch]).astype(np.float32)[..., None]
+            result = np.asarray(self.model.predict_on_batch(x_batch / 255.0))[..., 0]
+            for (y, x), tile in zip(batch, result):
+                probabilities[y:y + tile_h, x:x + tile_w] += tile * window
+        return (probabilities / weights)[:height, :width]
+
+    def predict_tiled(self, images_dir, save_path=False, overlap=128, batch_size=16,
+                      content_threshold=default_content_threshold, save_in_tiff=False, verbose=0):
+        """
+        Predicts the masks of all images in a folder at full resolution, see `predict_full_resolution`.
+        
+        The next image is decoded and the previous mask encoded in background threads while the model runs.
+        The throughput is reported in megapixels per second.
+        
+        Returns:
+            list: Names of the predicted images.
+        """
+        names = sorted(name for name in os.listdir(images_dir) if name.endswith(image_extensions))
+        if save_path:
+            os.makedirs(save_path, exist_ok=True)
+        stats = {'tiles': 0, 'skipped': 0}
+        pixels = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            read = lambda name: cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_GRAYSCALE)
+            next_img = executor.submit(read, names[0]) if names else None
+            writes = []
+            for id, name in enumerate(names):
+                img = next_img.result()
+                next_img = executor.submit(read, names[id + 1]) if id + 1 < len(names) else None
+                if img is None:
+                    print(f"could not read {name}")
+                    continue
+                mask = self.predict_full_resolution(img, overlap, batch_size, content_threshold, stats=stats)
+                pixels += img.size
+                if save_path:
+                    writes.append(executor.submit(cv2.imwrite, str(Path(save_path) / self.prediction_filename(
+                        name, save_in_tiff)), to_uint8_mask(mask)))
+                    # keep at most a few masks waiting to be written
+                    while len(writes) > 4:
+                        writes.pop(0).result()
+                if verbose:
+                    print(f"{name}: {stats['skipped']}/{stats['tiles']} tiles skipped so far")
+            for write in writes:
+                write.result()
+        elapsed = time.perf_counter() - start
+        print(f"Predicted {len(names)} images at full resolution in {elapsed:.1f}s "
+              f"({pixels / 1e6 / max(elapsed, 1e-9):.2f} MP/s, {stats['skipped']}/{stats['tiles']} tiles skipped)")
+        return names
+
+    def find_regions(self, img, coarse_model=None, coarse_threshold=default_coarse_threshold, margin=default_roi_margin):
+        """
+        Locates candidate wear regions of an image in one downscaled pass.
+        
+        The image is squashed to the input size of `coarse_model` (this model if None), the predicted probabilities
+        above `coarse_threshold` are grouped into connected components, and their boxes are scaled back to the image,
+        grown by `margin` pixels, enlarged to at least one tile and merged where they overlap.
+        
+        Returns:
+            list: (x0, y0, x1, y1) boxes in image pixels.
+        """
+        coarse = coarse_model.model if isinstance(coarse_model, WearDetector) else (coarse_model or self.model)
+        coarse_h, coarse_w = coarse.input_shape[1:3]
+        height, width = img.shape[:2]
+        small = cv2.resize(img, (coarse_w, coarse_h), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+        probabilities = np.asarray(coarse.predict_on_batch(small[None, ..., None]))[0, ..., 0]
+        count, _, components, _ = cv2.connectedComponentsWithStats((probabilities > coarse_threshold).astype(np.uint8))
+
+        scale_x, scale_y = width / coarse_w, height / coarse_h
+        boxes = []
+        for x, y, w, h, _ in components[1:count]:
+            x0, y0 = int(x * scale_x) - margin, int(y * scale_y) - margin
+            x1, y1 = int(math.ceil((x + w) * scale_x)) + margin, int(math.ceil((y + h) * scale_y)) + margin
+            # grow small boxes to a whole tile, so the fine pass sees the same context as on the full frame
+            grow_x, grow_y = max(self.IMG_WIDTH - (x1 - x0), 0), max(self.IMG_HEIGHT - (y1 - y0), 0)
+            x0, x1 = x0 - grow_x // 2, x1 + grow_x - grow_x // 2
+            y0, y1 = y0 - grow_y // 2, y1 + grow_y - grow_y // 2
+            # shift boxes back inside the image rather than cutting them
+            shift_x, shift_y = max(-x0, 0) - max(x1 - width, 0), max(-y0, 0) - max(y1 - height, 0)
+            boxes.append((max(x0 + shift_x, 0), max(y0 + shift_y, 0),
+                          min(x1 + shift_x, width), min(y1 + shift_y, height)))
+        return merge_boxes(boxes)
+
+    def predict_coarse_to_fine(self, img, coarse_model=None, coarse_threshold=default_coarse_threshold,
+                               margin=default_roi_margin, overlap=128, batch_size=16,
+                               content_threshold=default_content_threshold, stats=None):
+        """
+        Predicts the mask of an image at full resolution, but only inside the candidate regions of `find_regions`.
+        
+        Every region is predicted with `predict_full_resolution` and pasted into a frame-sized map, everything else is
+        background. `coarse_model` can be a lighter WearDetector or Keras model, by default this model runs both
+        passes. Lower `coarse_threshold` or raise `margin` if wear gets cut off.
+        
+        Args:
+            img (np.ndarray): (height, width) uint8 greyscale image.
+            content_threshold (float): Tiles of the regions without content are skipped, see `predict_full_resolution`.
+            stats (dict): Counts the 'regions' and the 'roi_pixels' that went through the fine pass.
+        
+        Returns:
+            np.ndarray: (height, width) float32 probability map.
+        """
+        probabilities = np.zeros(img.shape[:2], dtype=np.float32)
+        boxes = self.find_regions(img, coarse_model, coarse_threshold, margin)
+        for x0, y0, x1, y1 in boxes:
+            probabilities[y0:y1, x0:x1] = self.predict_full_resolution(img[y0:y1, x0:x1], overlap, batch_size,
+                                                                       content_threshold)
+        if stats is not None:
+            stats['regions'] = stats.get('regions', 0) + len(boxes)
+            stats['roi_pixels'] = stats.get('roi_pixels', 0) + sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+        return probabilities
+
     def predict_for_pics(self, pics, verbose=0):
-        images = []
-        # Load images and corresponding masks
-        for pic in pics:
-                images.append(np.array(pic, dtype=np.uint8)* 255.0 )
+        """Predicts the masks of pictures in memory, e.g. model.X[test_idx]. uint8 pictures are normalized to [0, 1]."""
+        images = np.asarray(pics)
+        if images.dtype == np.uint8:
+            images = images.astype(np.float32) / 255.0
         
-        # Convert list of images to 4D numpy array
-        images = np.expand_dims(np.array(images), axis=-1)
+        # Convert the stack of images to a 4D numpy array
+        images = np.expand_dims(images, axis=-1)
         
         return self.model.predict(images, verbose=verbose)
 
@@ -229,38 +1245,655 @@ class WearDetector(Model):
 
     def load_model(self, file_path):
         self.model = tf.keras.models.load_model(file_path)
-        self.model.compile()
+        self.initial_weights = self.model.get_weights()
+        self.model.compile(jit_compile=self.jit_compile)
         print(f"Model loaded from {file_path}")
 
-    def grid_search_train(self,param_grid, epochs=10, batch_size=10,test_size=0.2):
-        """Trains the model using GridSearchCV to find the best hyperparameters."""
-        X = self.X
-        y = self.y
-        param_grid = param_grid
-        grid = ParameterGrid(param_grid)
-        best_score = float('inf')
-        best_params = 0
-        X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=test_size)
-        for params in grid:
-            print("epochs|batch size|learning rate| test split rate")
-            print(params['epochs'], params['batch_size'],params['lr'],test_size)
-            score = self.train( epochs=params['epochs'], batch_size=params['batch_size'],lr=params['lr'],test_size=0.2)
-            if score < best_score:
-                best_score = score
-                best_params = params
-                self.save_model(f"best_model_lr_{params['lr']}_batch_{params['batch_size']}_epoch_{params['epochs']}.h5")
-        print("Best Loss:", best_score)
-        print("Best Hyperparameters:", best_params)
+    def export_saved_model(self, file_path='wear_detector_model', jit_compile=True, batch_size=None):
+        """Saves the model as a SavedModel with a 'serve' function, XLA-compiled by default, see `load_saved_model`."""
+        serve = tf.function(lambda x: self.model(x, training=False), jit_compile=jit_compile, input_signature=[
+            tf.TensorSpec((batch_size, self.IMG_HEIGHT, self.IMG_WIDTH, self.IMG_CHANNELS), tf.float32)])
+        serve.get_concrete_function()
+        # the export archive tracks the Keras 3 variables, which a plain tf.Module cannot freeze for the converter
+        archive = ExportArchive()
+        archive.track(self.model)
+        archive.add_endpoint('serve', serve)
+        archive.write_out(str(file_path))
+        print(f"Model exported to {file_path}")
+
+    def export_tflite(self, file_path='wear_detector_model.tflite', quantization='int8', calibration_dir='dataset/imgs',
+                      calibration_samples=default_calibration_samples, batch_size=1):
+        """
+        Saves the model as TFLite for CPU inference, see `load_tflite`.
         
-       
-       
-       
-       
-       
-       
-       
-       
+        Args:
+            file_path (str): Path of the .tflite file.
+            quantization (str): 'int8' quantizes weights and activations, calibrated on `calibration_samples` images
+                of `calibration_dir`. 'float16' halves the weights only, None keeps float32.
+            calibration_dir (str): Folder of images representative of the inputs.
+            calibration_samples (int): Number of images, spread evenly over the folder, to calibrate on.
+            batch_size (int): Fixed batch size of the exported graph, larger batches run in chunks of it.
+        
+        The converted model is loaded and run on one batch before it is written, a model the TFLite runtime
+        rejects raises a RuntimeError here instead of when it is served.
+        """
+        # the interpreter allocates its tensors for a fixed batch size, TFLiteBackend runs larger batches in chunks
+        saved_model_dir = tempfile.mkdtemp()
+        self.export_saved_model(saved_model_dir, jit_compile=False, batch_size=batch_size)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+        if quantization == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == 'int8':
+            names = sorted(name for name in os.listdir(calibration_dir) if name.endswith(image_extensions))
+            names = [names[int(i)] for i in np.linspace(0, len(names) - 1, min(calibration_samples, len(names)))]
+
+            def representative_dataset():
+                for name in names:
+                    img = read_resized(os.path.join(calibration_dir, name), (self.IMG_HEIGHT, self.IMG_WIDTH))
+                    if img is not None:
+                        yield [np.repeat(img[None, ..., None], batch_size, axis=0).astype(np.float32) / 255.0]
+
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+            # with per-channel weight scales the converter writes 16 scales for the Conv2DTranspose kernels of a
+            # trained model along an axis the runtime does not accept ("num_scales must be 1 ..."), quantize the
+            # weights per tensor. The converter has no public switch for this
+            converter._experimental_disable_per_channel = True
+        elif quantization is not None:
+            raise ValueError(f"unknown quantization {quantization}, use 'int8', 'float16' or None")
+        try:
+            content = converter.convert()
+        finally:
+            shutil.rmtree(saved_model_dir, ignore_errors=True)
+        try:
+            TFLiteBackend(model_content=content).predict_on_batch(
+                np.zeros((batch_size, self.IMG_HEIGHT, self.IMG_WIDTH, self.IMG_CHANNELS), np.float32))
+        except (RuntimeError, ValueError) as e:
+            raise RuntimeError(f"the {quantization or 'float32'} TFLite model does not run, not written: {e}") from e
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        print(f"Model exported to {file_path} ({quantization or 'float32'})")
+
+    def load_tflite(self, file_path, num_threads=None):
+        """Replaces the Keras model by an exported .tflite model for inference, training is no longer possible."""
+        self.model = TFLiteBackend(file_path, num_threads)
+        print(f"Model loaded from {file_path}")
+
+    def load_saved_model(self, file_path):
+        """Replaces the Keras model by an exported SavedModel for inference, training is no longer possible."""
+        self.model = SavedModelBackend(file_path)
+        print(f"Model loaded from {file_path}")
+
+    def share_dataset(self, directory):
+        """Returns the paths of .npy files of self.X and self.y that other processes can memory-map.
         
+        The cached stacks of `load_data` already are such files, other arrays are saved to `directory`.
+        """
+        shared = []
+        for name, array in (('images', self.X), ('masks', self.y)):
+            if isinstance(array, np.memmap) and str(array.filename).endswith('.npy'):
+                shared.append(str(array.filename))
+            else:
+                np.save(Path(directory) / f"{name}.npy", np.asarray(array))
+                shared.append(str(Path(directory) / f"{name}.npy"))
+        return shared
+
+    def architecture(self):
+        """Returns the WearDetector arguments of this model, to build a copy in another process."""
+        return {'filters': self.filters, 'dropout_rate': self.dropout_rate,
+                'target_size': (self.IMG_HEIGHT, self.IMG_WIDTH), 'IMG_CHANNELS': self.IMG_CHANNELS,
+                'depth': self.depth, 'width': self.width, 'separable': self.separable,
+                'jit_compile': self.jit_compile, 'mixed_precision': self.mixed_precision}
+
+    def train_distributed(self, workers=2, loss='binary_crossentropy', lr=0.01, epochs=10, batch_size=10, test_size=0.2,
+                          verbose=1, eval=True, augment=None):
+        """
+        Trains on the loaded data in `workers` local processes with synchronous data parallelism, see `train`.
+        
+        The processes form a MultiWorkerMirroredStrategy cluster over localhost and all-reduce the gradients after
+        every step. Each one is pinned to the cores of one NUMA node, round robin, or to its share of them when
+        there are more workers than nodes. Each reads only its shard of the training split from the shared
+        memory-mapped dataset, in batches of batch_size / workers, so a step still covers `batch_size` samples.
+        
+        Returns:
+            float: Validation loss after the last epoch.
+        """
+        train_idx, val_idx, _ = self.split_indices(test_size)
+        if min(len(train_idx), len(val_idx)) < workers:
+            raise ValueError(f"{len(train_idx)} training and {len(val_idx)} validation samples cannot be split over "
+                             f"{workers} workers, every worker needs at least one of both")
+        run_dir = Path(tempfile.mkdtemp(prefix='wear_detector_'))
+        try:
+            self.model.save_weights(str(run_dir / 'initial.weights.h5'))
+            config = {'shared': self.share_dataset(run_dir), 'architecture': self.architecture(),
+                      'run_dir': str(run_dir), 'loss': loss, 'lr': lr, 'epochs': epochs, 'batch_size': batch_size,
+                      'test_size': test_size, 'augment': augment, 'verbose': verbose}
+            ports = free_ports(workers)
+            context = multiprocessing.get_context('spawn')
+            processes = [context.Process(target=run_distributed_worker, args=(rank, workers, ports, config))
+                         for rank in range(workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            if any(process.exitcode != 0 for process in processes):
+                raise RuntimeError(f"distributed training failed, exit codes {[p.exitcode for p in processes]}")
+
+            self.model.load_weights(str(run_dir / 'trained.weights.h5'))
+            with open(run_dir / 'result.json') as f:
+                result = json.load(f)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        self.last_throughput = result['images_per_s']
+        print(f"Distributed training on {workers} workers complete, {result['images_per_s']:.1f} images/s")
+        if eval:
+            _, _, test_idx = self.split_indices(test_size)
+            self.prepare_training(loss, lr)
+            self.evaluate(self.make_dataset(test_idx, batch_size))
+        return result['val_loss']
+
+    def grid_search_train(self,param_grid, epochs=10, batch_size=10,test_size=0.2, processes=None, min_epochs=1, eta=3,
+                          search_dir='grid_search'):
+        """
+        Searches the hyperparameters of `param_grid` on the loaded data with successive halving.
+        
+        All combinations are trained for `min_epochs` epochs first, then only the best 1/eta of them continue, for eta
+        times as many epochs, and so on until the survivors reach `epochs`. An 'epochs' entry of the grid sets that
+        budget instead of being searched. The trials of a round run in a pool of `processes` processes, which share
+        the dataset as memory-mapped .npy files and continue from the weights the previous round left in
+        `search_dir`. The optimizer starts afresh in every round. The trials run with the jit_compile and
+        mixed_precision of this WearDetector, so they are ranked in the numeric mode the best model is used in.
+        
+        Every finished trial is appended to search_dir/journal.jsonl with its validation loss, a search started again
+        on the same directory skips the trials found there. The best model is saved as search_dir/best_model.h5 and
+        loaded into this WearDetector along with its architecture.
+        
+        Args:
+            param_grid (dict): Values to search of the arguments of `train` (lr, batch_size, loss, ...) and of the
+                architecture (filters, dropout_rate, depth, width, separable). Loss functions have to be defined at
+                module level so the search processes can import them, they are journaled by name.
+            epochs (int): Epochs of the trials that make it to the last round.
+            batch_size (int): Batch size of the trials if not searched.
+            processes (int): Number of trials trained in parallel, os.cpu_count() if None. The cores are shared
+                between the trials of a round, as fewer trials survive each gets more threads.
+            min_epochs (int): Epochs of the first round.
+            eta (int): Factor the trials are reduced by and the epochs grow by from round to round.
+        
+        Returns:
+            tuple: Best parameters and their validation loss.
+        """
+        param_grid = {key: list(value) if isinstance(value, (list, tuple)) else [value] for key, value in param_grid.items()}
+        epochs = int(max(param_grid.pop('epochs', [epochs])))
+        search_dir = Path(search_dir)
+        os.makedirs(search_dir, exist_ok=True)
+        processes = processes or os.cpu_count()
+        modes = {'jit_compile': self.jit_compile, 'mixed_precision': self.mixed_precision}
+
+        trials = []
+        for params in ParameterGrid(param_grid):
+            key = trial_key(params)
+            try:
+                pickle.dumps(params)
+            except (pickle.PicklingError, AttributeError, TypeError) as e:
+                raise ValueError(f"the parameters {key} cannot be sent to the search processes, define loss "
+                                 f"functions at module level: {e}") from e
+            trials.append({'params': params, 'key': key,
+                           'checkpoint': str(search_dir / f"trial-{hashlib.sha1(key.encode()).hexdigest()[:12]}"),
+                           'model_args': {k: v for k, v in params.items() if k in architecture_params},
+                           'modes': modes,
+                           'train_args': {'batch_size': batch_size, 'test_size': float(test_size),
+                                          **{k: v for k, v in params.items() if k not in architecture_params}}})
+
+        journal_path = search_dir / 'journal.jsonl'
+        journal = {}
+        if journal_path.exists():
+            with open(journal_path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        journal[(entry['key'], entry['epochs'])] = entry['val_loss']
+            print(f"Resuming search, {len(journal)} trials found in {journal_path}")
+
+        shared = self.share_dataset(search_dir)
+        survivors = trials
+        done_epochs = 0
+        rung = 0
+        executor, pool_size = None, 0
+        try:
+            while True:
+                budget = min(min_epochs * eta ** rung, epochs)
+                print(f"Round {rung}: {len(survivors)} trials, {done_epochs} -> {budget} epochs")
+                pending = [trial for trial in survivors if (trial['key'], budget) not in journal]
+                # the thread pools of TensorFlow cannot be resized once it runs, start new processes with more
+                # threads each when fewer trials are left than processes
+                if pending and min(processes, len(pending)) != pool_size:
+                    if executor is not None:
+                        executor.shutdown()
+                    pool_size = min(processes, len(pending))
+                    executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=init_search_worker,
+                                                   initargs=(shared, max(os.cpu_count() // pool_size, 1)))
+                futures = {executor.submit(run_search_trial, dict(trial, initial_epoch=done_epochs, epochs=budget)):
+                           trial for trial in pending}
+                for future in as_completed(futures):
+                    trial = futures[future]
+                    val_loss = future.result()
+                    journal[(trial['key'], budget)] = val_loss
+                    with open(journal_path, 'a') as f:
+                        f.write(json.dumps({'key': trial['key'], 'params': json.loads(trial['key']), 'rung': rung,
+                                            'epochs': budget, 'val_loss': val_loss}) + '\n')
+                    print(f"{trial['key']}: validation loss {val_loss:.4f} after {budget} epochs")
+
+                survivors = sorted(survivors, key=lambda trial: journal[(trial['key'], budget)])
+                if budget >= epochs:
+                    break
+                survivors = survivors[:max(len(survivors) // eta, 1)]
+                done_epochs = budget
+                rung += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        best = survivors[0]
+        best_score = journal[(best['key'], epochs)]
+        best_model = WearDetector(target_size=(self.IMG_HEIGHT, self.IMG_WIDTH), **modes, **best['model_args'])
+        self.model, self.initial_weights = best_model.model, best_model.initial_weights
+        # later builds and copies of this WearDetector have to give the best architecture as well
+        for name, value in best['model_args'].items():
+            setattr(self, name, value)
+        self.model.load_weights(checkpoint_path(best, epochs))
+        self.save_model(str(search_dir / 'best_model.h5'))
+        print("Best Loss:", best_score)
+        print("Best Hyperparameters:", best['params'])
+        return best['params'], best_score
+
+
+def describe_value(value):
+    """Names a value that JSON cannot hold, a function or class by its module and qualified name."""
+    if hasattr(value, '__qualname__'):
+        return f"{getattr(value, '__module__', '')}.{value.__qualname__}"
+    return repr(value)
+
+
+def trial_key(params):
+    """Returns the JSON key of the parameters of a `grid_search_train` trial, e.g. a loss function by its name."""
+    return json.dumps(params, sort_keys=True, default=describe_value)
+
+
+def init_search_worker(shared, threads):
+    """Initializes a process of `grid_search_train`: maps the shared dataset and shares the cores between trials."""
+    configure_threads(threads, threads)
+    search_dataset['X'] = np.load(shared[0], mmap_mode='r')
+    search_dataset['y'] = np.load(shared[1], mmap_mode='r')
+
+
+def run_search_trial(trial):
+    """Trains a trial of `grid_search_train` from its initial to its final epoch and returns its validation loss."""
+    X = search_dataset['X']
+    # build and trace every architecture once per process, later trials only reset the weights
+    models = search_dataset.setdefault('models', {})
+    key = trial_key({**trial['model_args'], **trial['modes']})
+    if key not in models:
+        models[key] = WearDetector(target_size=X.shape[1:3], **trial['modes'], **trial['model_args'])
+        models[key].X, models[key].y = X, search_dataset['y']
+    model = models[key]
+    if trial['initial_epoch']:
+        model.model.load_weights(checkpoint_path(trial, trial['initial_epoch']))
+    else:
+        model.reset_weights()
+    val_loss = model.train(epochs=trial['epochs'], initial_epoch=trial['initial_epoch'], verbose=0, eval=False,
+                           **trial['train_args'])
+    # write the checkpoint in one step, the journal entry is only written after it
+    tmp_checkpoint = checkpoint_path(trial, trial['epochs']).replace('.weights.h5', '.tmp.weights.h5')
+    model.model.save_weights(tmp_checkpoint)
+    os.replace(tmp_checkpoint, checkpoint_path(trial, trial['epochs']))
+    return float(val_loss)
+
+
+def numa_cpu_sets():
+    """Returns the sets of CPUs of the NUMA nodes, a single set of all usable CPUs if the topology is unknown."""
+    cpu_sets = []
+    for node in sorted(Path('/sys/devices/system/node').glob('node[0-9]*'), key=lambda node: int(node.name[4:])):
+        cpus = set()
+        for part in (node / 'cpulist').read_text().strip().split(','):
+            if part:
+                first, _, last = part.partition('-')
+                cpus.update(range(int(first), int(last or first) + 1))
+        cpus &= os.sched_getaffinity(0)
+        if cpus:
+            cpu_sets.append(cpus)
+    return cpu_sets or [os.sched_getaffinity(0)]
+
+
+def worker_cpus(rank, workers):
+    """Returns the CPUs of a data-parallel worker: the workers go round robin over the NUMA nodes and split the
+    CPUs of a node between them."""
+    nodes = numa_cpu_sets()
+    node = rank % len(nodes)
+    sharing = [r for r in range(workers) if r % len(nodes) == node]
+    cpus = sorted(nodes[node])
+    share = max(len(cpus) // len(sharing), 1)
+    index = sharing.index(rank)
+    return set(cpus[index * share:(index + 1) * share] or cpus)
+
+
+def free_ports(count):
+    """Returns `count` free TCP ports on localhost."""
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(('localhost', 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def run_distributed_worker(rank, workers, ports, config):
+    """Trains one process of `WearDetector.train_distributed`, rank 0 writes the weights and the result."""
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = worker_cpus(rank, workers)
+        os.sched_setaffinity(0, cpus)
+        configure_threads(len(cpus))
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': [f"localhost:{port}" for port in ports]},
+                                          'task': {'type': 'worker', 'index': rank}})
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING))
+
+    # the strategy cannot broadcast the uint32 seed states of the Dropout layers, keep them per worker, which
+    # also gives every worker its own dropout masks. Only the internal variable class bypasses the creators of the
+    # strategy, any tf.Variable goes through them again
+    try:
+        from tensorflow.python.ops.resource_variable_ops import ResourceVariable
+    except ImportError as e:
+        raise RuntimeError(f"distributed training needs the variable class of TensorFlow 2.16, TensorFlow "
+                           f"{tf.__version__} moved it") from e
+
+    def local_seed_states(next_creator, **kwargs):
+        if kwargs.get('dtype') == tf.uint32:
+            return ResourceVariable(**{key: value for key, value in kwargs.items()
+                                       if key in ('initial_value', 'trainable', 'name', 'dtype', 'shape')})
+        return next_creator(**kwargs)
+
+    with strategy.scope(), tf.variable_creator_scope(local_seed_states):
+        model = WearDetector(**config['architecture'])
+        model.model.load_weights(str(Path(config['run_dir']) / 'initial.weights.h5'))
+        model.prepare_training(config['loss'], config['lr'])
+    model.X = np.load(config['shared'][0], mmap_mode='r')
+    model.y = np.load(config['shared'][1], mmap_mode='r')
+
+    train_idx, val_idx, _ = model.split_indices(config['test_size'])
+    # equal shards, every worker has to run the same number of steps, train_distributed checked that none is empty
+    train_shard = np.sort(train_idx)[:len(train_idx) // workers * workers][rank::workers]
+    val_shard = np.sort(val_idx)[:len(val_idx) // workers * workers][rank::workers]
+    batch_size = max(config['batch_size'] // workers, 1)
+    # the strategy splits every batch of a worker into batches of batch_size / workers, each worker reads its own
+    # shard, so the datasets are batched with the global batch size and not sharded again
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    train_ds = strategy.experimental_distribute_dataset(model.make_dataset(
+        train_shard, batch_size * workers, training=True, augment=config['augment'],
+        epochs=config['epochs']).with_options(options))
+    val_ds = strategy.experimental_distribute_dataset(
+        model.make_dataset(val_shard, batch_size * workers).with_options(options))
+
+    throughput = ThroughputCallback(batch_size * workers)
+    history = model.model.fit(train_ds, epochs=config['epochs'], callbacks=[throughput],
+                              steps_per_epoch=int(math.ceil(len(train_shard) / batch_size)),
+                              validation_data=val_ds,
+                              verbose=config['verbose'] if rank == 0 else 0)
+    # every worker holds the same weights, the others save to their own directory as the strategy requires
+    weights_dir = Path(config['run_dir']) if rank == 0 else Path(config['run_dir']) / f"worker-{rank}"
+    os.makedirs(weights_dir, exist_ok=True)
+    model.model.save_weights(str(weights_dir / 'trained.weights.h5'))
+    if rank == 0:
+        rates = throughput.rates[1:] or throughput.rates
+        with open(Path(config['run_dir']) / 'result.json', 'w') as f:
+            json.dump({'val_loss': float(history.history['val_loss'][-1]),
+                       'images_per_s': float(np.mean(rates)) if rates else float('nan')}, f)
+
+
+def benchmark_data_parallel(model, worker_counts=(1, 2, 4), epochs=3, batch_size=8, lr=0.001):
+    """
+    Trains a copy of the architecture of `model` on its loaded data with 1, 2, 4... data-parallel workers, see
+    `WearDetector.train_distributed`, and reports the images/s after the first epoch and the scaling efficiency,
+    the speed-up over one worker divided by the number of workers.
+    """
+    detector = WearDetector(**model.architecture())
+    detector.X, detector.y = model.X, model.y
+    report = []
+    for workers in worker_counts:
+        detector.reset_weights()
+        detector.train_distributed(workers, lr=lr, epochs=epochs, batch_size=batch_size, verbose=0, eval=False)
+        report.append({'workers': workers, 'images_per_s': detector.last_throughput})
+        report[-1]['efficiency'] = detector.last_throughput / (workers * report[0]['images_per_s'])
+        print("{workers} workers: {images_per_s:.1f} images/s, scaling efficiency {efficiency:.0%}".format(**report[-1]))
+    return report
+
+
+def benchmark_precision_modes(model, epochs=2, batch_size=10, lr=0.001,
+                              modes=((False, False), (True, False), (False, True), (True, True))):
+    """
+    Trains a copy of the architecture of `model` on its loaded data for every (jit_compile, mixed_precision) mode
+    and reports the training images/s, measured after a warm-up epoch, and the Dice on the test split.
+    
+    All modes run with the thread pools of the process, which are reported along with them. Run the benchmark in a
+    fresh process to measure them with the pools the performance modes size, see `configure_threads`.
+    """
+    train_idx, _, test_idx = model.split_indices()
+    target = np.asarray(model.y[np.sort(test_idx)]) > 127
+    report = []
+    for jit_compile, mixed_precision in modes:
+        detector = WearDetector(model.filters, model.dropout_rate, (model.IMG_HEIGHT, model.IMG_WIDTH),
+                                model.IMG_CHANNELS, model.depth, model.width, model.separable, jit_compile,
+                                mixed_precision)
+        detector.X, detector.y = model.X, model.y
+        # trace and compile the train step, the timed run reuses it
+        detector.train(lr=lr, epochs=1, batch_size=batch_size, verbose=0, eval=False)
+        detector.reset_weights()
+        start = time.perf_counter()
+        detector.train(lr=lr, epochs=epochs, batch_size=batch_size, verbose=0, eval=False)
+        elapsed = time.perf_counter() - start
+        predicted = detector.predict_for_pics(model.X[np.sort(test_idx)])[..., 0] > 0.5
+        report.append({'jit_compile': jit_compile, 'mixed_precision': detector.mixed_precision,
+                       'intra_op_threads': tf.config.threading.get_intra_op_parallelism_threads(),
+                       'inter_op_threads': tf.config.threading.get_inter_op_parallelism_threads(),
+                       'images_per_s': len(train_idx) * epochs / elapsed,
+                       'dice': segmentation_scores(predicted, target)['dice']})
+        print("jit_compile={jit_compile}, mixed_precision={mixed_precision}, threads {intra_op_threads}/"
+              "{inter_op_threads}: {images_per_s:.1f} images/s, dice {dice:.4f}".format(**report[-1]))
+    return report
+
+
+def benchmark_trial_startup(model, trials=3, batch_size=10, lr=0.001):
+    """
+    Compares the time per one-epoch trial when every trial builds and compiles a new WearDetector with resetting
+    the weights of one compiled model, on the data loaded into `model`. The difference is the start-up overhead
+    `reset_weights` and `prepare_training` save per trial. Both arms train copies of the architecture of `model`,
+    its own weights are left alone.
+    """
+    def run(detector):
+        start = time.perf_counter()
+        detector.train(lr=lr, epochs=1, batch_size=batch_size, verbose=0, eval=False)
+        return time.perf_counter() - start
+
+    rebuilt = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        detector = WearDetector(**model.architecture())
+        detector.X, detector.y = model.X, model.y
+        rebuilt.append(time.perf_counter() - start + run(detector))
+
+    reusable = WearDetector(**model.architecture())
+    reusable.X, reusable.y = model.X, model.y
+    reused = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        reusable.reset_weights()
+        reused.append(time.perf_counter() - start + run(reusable))
+    # the first reused trial still traces the train step
+    report = {'rebuild_s': float(np.mean(rebuilt)), 'reuse_first_s': reused[0],
+              'reuse_s': float(np.mean(reused[1:] or reused))}
+    report['overhead_saved_s'] = report['rebuild_s'] - report['reuse_s']
+    print("per trial: rebuild {rebuild_s:.2f}s, reuse {reuse_s:.2f}s (first {reuse_first_s:.2f}s), "
+          "{overhead_saved_s:.2f}s start-up saved".format(**report))
+    return report
+
+
+def checkpoint_path(trial, epochs):
+    """Returns the path of the weights of a `grid_search_train` trial after `epochs` epochs."""
+    return f"{trial['checkpoint']}-{epochs}.weights.h5"
+
+
+def benchmark_roi_inference(model, images_dir='dataset/imgs', coarse_model=None,
+                            coarse_threshold=default_coarse_threshold, margin=default_roi_margin, limit=None,
+                            content_threshold=default_content_threshold, overlap=128):
+    """
+    Compares coarse-to-fine inference with running the model over the whole frame on the images of a folder.
+    
+    Reports the frames per second of both paths, the share of the frame the fine pass had to look at, and the recall
+    of the coarse-to-fine masks against the full-frame masks at a 0.5 threshold. Both paths skip tiles below the
+    same `content_threshold` and tile `overlap`, so the speed-up is the one of the region cropping alone. An overlap
+    that does not fit into the tiles of `model` is reduced, see `WearDetector.tile_overlap`.
+    """
+    overlap = model.tile_overlap(overlap)
+    names = sorted(name for name in os.listdir(images_dir) if name.endswith(image_extensions))[:limit]
+    imgs = [img for img in (cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_GRAYSCALE) for name in names)
+            if img is not None]
+    # warm up both paths, the first calls trace the models
+    model.predict_full_resolution(imgs[0], overlap, content_threshold=content_threshold)
+    model.predict_coarse_to_fine(imgs[0], coarse_model, coarse_threshold, margin, overlap,
+                                 content_threshold=content_threshold)
+
+    start = time.perf_counter()
+    full = [model.predict_full_resolution(img, overlap, content_threshold=content_threshold) for img in imgs]
+    full_time = time.perf_counter() - start
+
+    stats = {}
+    start = time.perf_counter()
+    roi = [model.predict_coarse_to_fine(img, coarse_model, coarse_threshold, margin, overlap,
+                                        content_threshold=content_threshold, stats=stats) for img in imgs]
+    roi_time = time.perf_counter() - start
+
+    positives = sum(int(np.count_nonzero(mask > 0.5)) for mask in full)
+    found = sum(int(np.count_nonzero((a > 0.5) & (b > 0.5))) for a, b in zip(full, roi))
+    report = {'frames': len(imgs), 'overlap': overlap,
+              'full_frame_fps': len(imgs) / full_time,
+              'coarse_to_fine_fps': len(imgs) / roi_time,
+              'roi_fraction': stats.get('roi_pixels', 0) / sum(img.size for img in imgs),
+              'regions_per_frame': stats.get('regions', 0) / len(imgs),
+              'recall': found / positives if positives else 1.0}
+    print("full frame: {full_frame_fps:.2f} frames/s, coarse-to-fine: {coarse_to_fine_fps:.2f} frames/s, "
+          "{roi_fraction:.1%} of the frame refined, recall {recall:.3f}".format(**report))
+    return report
+
+
+def compare_backends(model, backends, images_dir='dataset/imgs', masks_dir='dataset/msks', limit=32, batch_size=8,
+                     report_path='export_report.json'):
+    """
+    Compares exported models with the float32 Keras model of a WearDetector and writes the results as JSON.
+    
+    For every backend the median single-image latency, the throughput in batches of `batch_size`, the Dice/IoU
+    against the masks at a 0.5 threshold and the deltas to the float32 model are reported, along with the Dice of
+    its masks against the float32 masks.
+    
+    Args:
+        model (WearDetector): Model holding the float32 Keras model.
+        backends (dict): Names mapped to exports, e.g. {'int8': TFLiteBackend('wear_detector_model.tflite')}.
+        limit (int): Number of image/mask pairs of the folders to compare on.
+    """
+    pairs = pair_files(images_dir, masks_dir, extensions=image_extensions)[:limit]
+    images, masks = read_samples(images_dir, masks_dir, pairs, (model.IMG_HEIGHT, model.IMG_WIDTH))
+    x = images[..., None].astype(np.float32) / 255.0
+    target = masks > 127
+
+    report = {}
+    reference = None
+    for name, backend in {'float32': model.model, **backends}.items():
+        backend.predict_on_batch(x[:1])
+        latencies = []
+        for sample in x[:min(len(x), 10)]:
+            start = time.perf_counter()
+            backend.predict_on_batch(sample[None])
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        predicted = np.concatenate([np.asarray(backend.predict_on_batch(x[i:i + batch_size]))
+                                    for i in range(0, len(x), batch_size)])[..., 0] > 0.5
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = predicted
+        scores = segmentation_scores(predicted, target)
+        report[name] = {'latency_ms': 1000 * float(np.median(latencies)),
+                        'images_per_s': len(x) / elapsed,
+                        **scores,
+                        'dice_delta': scores['dice'] - report.get('float32', scores)['dice'],
+                        'iou_delta': scores['iou'] - report.get('float32', scores)['iou'],
+                        'dice_vs_float32': segmentation_scores(predicted, reference)['dice']}
+        print("{}: {latency_ms:.1f} ms, {images_per_s:.1f} images/s, dice {dice:.4f} ({dice_delta:+.4f}), "
+              "iou {iou:.4f} ({iou_delta:+.4f})".format(name, **report[name]))
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def count_flops(model):
+    """Returns the floating point operations of one forward pass of a sample, counted over the convolutions."""
+    flops = 0
+    for layer in model.layers:
+        if not isinstance(layer, (Conv2D, SeparableConv2D, Conv2DTranspose)):
+            continue
+        in_channels = layer.input.shape[-1]
+        kernel = int(np.prod(layer.kernel_size))
+        if isinstance(layer, SeparableConv2D):
+            height, width = layer.output.shape[1:3]
+            macs = height * width * in_channels * (kernel + layer.filters)
+        elif isinstance(layer, Conv2DTranspose):
+            # every input pixel is spread over a kernel-sized patch of the output
+            height, width = layer.input.shape[1:3]
+            macs = height * width * kernel * in_channels * layer.filters
+        else:
+            height, width = layer.output.shape[1:3]
+            macs = height * width * kernel * in_channels * layer.filters
+        flops += 2 * macs
+    return flops
+
+
+def benchmark_variants(variants=default_variants, target_size=(512, 512), batch_size=1, runs=10, budget_ms=10):
+    """
+    Reports the cost of U-Net variants to pick one that fits a latency budget, see `WearDetector.build_model`.
+    
+    For every variant the GFLOPs of a sample, the parameter count, the median CPU latency of a batch and the memory
+    of the float32 weights and of all activations of a batch (an upper bound, the runtime reuses buffers) are given.
+    
+    Args:
+        variants (list): WearDetector arguments of every variant, e.g. {'width': 0.5, 'separable': True}.
+        budget_ms (float): Variants with a median latency below this are marked.
+    """
+    report = []
+    for variant in variants:
+        model = WearDetector(target_size=target_size, **variant).model
+        x = np.random.default_rng(default_seed).random((batch_size,) + tuple(target_size) + (1,), dtype=np.float32)
+        model.predict_on_batch(x)
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.predict_on_batch(x)
+            latencies.append(time.perf_counter() - start)
+        activations = sum(int(np.prod(layer.output.shape[1:])) for layer in model.layers)
+        report.append({'variant': variant,
+                       'gflops': count_flops(model) / 1e9,
+                       'params': model.count_params(),
+                       'latency_ms': 1000 * float(np.median(latencies)),
+                       'weights_mb': model.count_params() * 4 / 2 ** 20,
+                       'activations_mb': activations * batch_size * 4 / 2 ** 20})
+        report[-1]['within_budget'] = report[-1]['latency_ms'] < budget_ms
+        print("{variant}: {gflops:.2f} GFLOPs, {params} params, {latency_ms:.1f} ms, weights {weights_mb:.1f} MB, "
+              "activations {activations_mb:.1f} MB{}".format(" *" if report[-1]['within_budget'] else "",
+                                                            **report[-1]))
+    return report
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Manage the WearDetector model.')
     parser.add_argument("--interactive_off", action="store_true", help="Run script in interactive mode (default interactive is on).",default=False)